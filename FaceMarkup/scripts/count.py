@@ -1,12 +1,23 @@
 #!/usr/bin/env python
 # Create a spreadsheet with annotation counts, per user and per file.
 # Run pull_annotations.sh first to rsync the *.raw files to here.
+#
+# Point counts are cached per *.raw file in CACHEFILE, keyed on the file's
+# modification time and size, so that only new or updated annotations are
+# read on subsequent runs.
+# The spreadsheet (csv) is written to stdout, summary statistics to stderr.
 
+from __future__ import print_function
 import os
 import sys
 import glob
-from collections import defaultdict
+import json
 
+import numpy as np
+
+
+CACHEFILE = './count-cache.json'
+BUFSIZE   = 1 << 20
 
 
 # list all *.raw files       --> files
@@ -27,43 +38,84 @@ def listusers(pat):
 	return sorted(users)
 
 def countpoints(fname):
-	return len(open(fname).readlines())
-
-def nnz(tup):
-	return sum(ti > 0 for ti in tup)
+	# same as len(readlines()): a last line without newline counts as well
+	n    = 0
+	last = b'\n'
+	with open(fname, 'rb') as f:
+		for buf in iter(lambda: f.read(BUFSIZE), b''):
+			n   += buf.count(b'\n')
+			last = buf[-1:]
+	return n + (last != b'\n')
+
+def loadcache(fname):
+	try:
+		with open(fname) as f:
+			return json.load(f)
+	except (IOError, ValueError):
+		return {}
+
+def savecache(fname, cache):
+	with open(fname + '.tmp', 'w') as f:
+		json.dump(cache, f)
+	os.rename(fname + '.tmp', fname)
+
+def cachedcount(fname, cache, oldcache):
+	st  = os.stat(fname)
+	key = [st.st_mtime, st.st_size]
+	hit = oldcache.get(fname)
+	n   = hit[2] if hit and hit[:2] == key else countpoints(fname)
+	cache[fname] = key + [n]
+	return n
 
 
 
 def main():
 	files_pat = '../images/*.wrl'
 	files     = listfiles(files_pat)
-	
+	rows      = dict((f,i) for i,f in enumerate(files))
+
 	users_pat = './manual-*'
 	users     = listusers(users_pat)
-	
-	points    = dict((u,defaultdict(int)) for u in users)
-	
-	for i,u in enumerate(users):
+
+	oldcache  = loadcache(CACHEFILE)
+	cache     = {}
+	points    = np.zeros((len(files), len(users)), dtype=np.int64)
+
+	for j,u in enumerate(users):
 		ufiles_pat = os.path.join(users_pat.replace('*',u), '*.raw')
 		ufiles     = listfiles(ufiles_pat)
-		uraw       = map(lambda f: ufiles_pat.replace('*', f), ufiles)
-		
-		print >> sys.stderr, '%15s: %d' % (u, len(ufiles))
-		
-		points[u].update(zip(ufiles, map(countpoints, uraw)))
-	
-	mat = [(f,) + tuple(points[u][f] for u in users) for f in files]
-	mat = [mi + (nnz(mi[1:]),) for i,mi in enumerate(mat)]
-	# sort on total number of annotations, then file name
-	mat.sort(key=lambda t:(t[-1],t[0]))
-	
-	for i,mi in enumerate(mat):
-		print ','.join(map(str, mi))
 
+		print('%15s: %d' % (u, len(ufiles)), file=sys.stderr)
 
-if __name__ == '__main__':
-	main()
+		for f in filter(lambda f: f in rows, ufiles):
+			n = cachedcount(ufiles_pat.replace('*', f), cache, oldcache)
+			points[rows[f], j] = n
+
+	savecache(CACHEFILE, cache)
+
+	nnz   = np.count_nonzero(points, axis=1)
+	# sort on total number of annotations, then file name (files are sorted)
+	order = np.argsort(nnz, kind='stable')
 
+	out = sys.stdout
+	for i in order:
+		out.write(','.join([files[i]] + [str(n) for n in points[i]] + [str(nnz[i])]))
+		out.write('\n')
 
+	# summary statistics
+	annotated = np.count_nonzero(points, axis=0)
+	print('', file=sys.stderr)
+	print('%15s  %8s %8s %8s' % ('user', 'files', 'points', 'mean'), file=sys.stderr)
+	for j,u in enumerate(users):
+		mean = points[:,j].sum() / float(annotated[j]) if annotated[j] else 0.0
+		print('%15s  %8d %8d %8.1f' % (u, annotated[j], points[:,j].sum(), mean),
+		      file=sys.stderr)
+	hist = np.bincount(nnz, minlength=len(users)+1)
+	print('', file=sys.stderr)
+	for k,n in enumerate(hist):
+		print('%d files annotated by %d user(s)' % (n, k), file=sys.stderr)
 
 
+if __name__ == '__main__':
+	main()
+
@@ -14,6 +14,7 @@ texture files.
 
 Note that if the .jpg file is not present, the .wrl file will NOT be modified.
 """
+from __future__ import print_function
 import re, os, sys
 
 
@@ -78,7 +79,7 @@ def updatewrl(path, wrlname, delete_original=False):
 if __name__ == '__main__':
   wrldir = sys.argv[1] if len(sys.argv)>1 else '.'
   if not os.path.isdir(wrldir):
-    print 'Error: That path is not a directory. Aborting.'
+    print('Error: That path is not a directory. Aborting.')
     sys.exit(1)
   
   wrlfiles = ((path,fname) for (path,dirs,files) in os.walk(wrldir) \
@@ -86,8 +87,8 @@ if __name__ == '__main__':
         os.path.isfile(os.path.join(path,fname[:-4]+'.jpg')))
   
   for path,wrlname in wrlfiles:
-    print wrlname + '...',
-    print 'done' if updatewrl(path,wrlname) else 'failed'
+    print(wrlname + '...', end=' ')
+    print('done' if updatewrl(path,wrlname) else 'failed')
   print('finished.')
 
 
@@ -1,32 +1,55 @@
 #!/usr/bin/env python
 '''
 Usage:
- preprocess1.py [FOLDER]
+ preprocess1.py [FOLDER] [-n | --dry-run] [-j N | --jobs N] [-p PLANFILE] [-r | --resume]
 
 Recursively find all .jpg and .wrl files in FOLDER,
  rename according to PoBI format, and
  organise in "probably-ears" and "probably-faces" folders.
  "probably-ears" and "probably-faces" are local (relative to cwd, not to FOLDER)
 
+The complete move plan is computed up front and checked for collisions
+(two sources mapping onto the same target, or a target that already exists
+while its source is still in place) before anything is touched. Renames and
+.wrl texture fixes then run on a pool of N threads (defaults to the number of
+CPUs).
+
+The plan is written to PLANFILE before it is applied and removed once it has
+been applied completely. If a run is interrupted, PLANFILE stays behind; run
+the script again with --resume to read it instead of searching FOLDER: moves
+whose source is gone are counted as done. Without --resume the script refuses
+to run while PLANFILE exists, so a stale plan never hides a new FOLDER.
+A resumed run also fixes the texture of the .wrl files moved before the
+interruption, so the plan may stop anywhere, including during the fixes.
+
+-n | --dry-run       Print the move plan and exit without touching any file.
+-j N | --jobs N      Number of worker threads.
+-p FILE | --plan FILE
+                     Plan file, defaults to "preprocess1.plan" (in cwd).
+-r | --resume        Resume the interrupted run recorded in the plan file.
+
 Note:
  To extract zip files efficiently run unzip with the following arguments,
  counting the number of asterixes required for the depth of those files within
  the archives. This will keep the path structure present in the zip files (as
  required by `preprocess1.py`), but limits the extraction to *.wrl and *.jpg
  files only.
- `unzip -Ppassword /path/to/\*.zip \*/\*/\*.wrl \*/\*/\*.jpg`
+ `unzip -Ppassword /path/to/\\*.zip \\*/\\*/\\*.wrl \\*/\\*/\\*.jpg`
 '''
+from __future__ import print_function
 from   collections import defaultdict
+from   multiprocessing.pool import ThreadPool
+import argparse
+import multiprocessing
 import os
-import re
-#import shutil
 import sys
-#import subprocess
-#import stat
 
 from fixwrl import updatewrl
 
 
+FACES = 'probably-faces'
+EARS  = 'probably-ears'
+
 
 
 def bitsandpieces(path, filename):
@@ -41,49 +64,169 @@ def bitsandpieces(path, filename):
 
 
 
-def main(folder):
+def make_plan(folder):
+  """ Compute the complete move plan for FOLDER.
+  Returns a list of `(source, target)` tuples. Per subject the first two
+  files (sorted on their new name, .jpg and .wrl alike) go to FACES, the
+  rest to EARS.
+  Targets in FACES and EARS are relative to cwd.
+  """
   h    = defaultdict(list)
   bits = (bitsandpieces(path, f)
       for (path,dirs,files) in os.walk(folder)
       for f in files
       if f.lower().endswith('.wrl') or f.lower().endswith('.jpg'))
 
-  # -- rename all files
-  #    moving them to cwd in the process
-  
   for fullname, stu, newname in bits:
-    h[stu].append(newname)
-    os.rename(fullname, newname)  # <- preferred
-    #copyfile(fullname, newname)  # <- only when folders are read-only
-
-  # -- distribute over "probably-ears" and "probably-faces" subfolders
-  #    fix .wrl files in the process
-  
-  notfixed = []
-  
-  os.makedirs('probably-ears')
-  os.makedirs('probably-faces')
-  
-  for stu in h:
-    photos   = sorted(h[stu])  # includes both .wrl and .jpg
-    wrl      = (f for f in photos if f.endswith('.wrl') and \
-          os.path.isfile(f[:-4]+'.jpg'))
-    notfixed.extend(filter(lambda f: not fixwrl('',f), wrl))
-    for f in photos[:2]:
-      os.rename(f, os.path.join('probably-faces', f))
-    for f in photos[2:]:
-      os.rename(f, os.path.join('probably-ears', f))
-  
+    # do not plan to move files that were organised in an earlier run
+    if os.path.split(os.path.dirname(os.path.abspath(fullname)))[1] in (FACES, EARS):
+      continue
+    h[stu].append((newname, fullname))
+
+  plan = []
+  for stu in sorted(h):
+    photos = sorted(h[stu])  # includes both .wrl and .jpg
+    for i, (newname, fullname) in enumerate(photos):
+      plan.append((fullname, os.path.join(FACES if i < 2 else EARS, newname)))
+  return plan
+
+
+def save_plan(plan, planfile):
+  with open(planfile, 'w') as f:
+    f.writelines('%s\t%s\n' % move for move in plan)
+
+
+def load_plan(planfile):
+  with open(planfile) as f:
+    return [tuple(line.rstrip('\n').split('\t')) for line in f if line.strip()]
+
+
+def check_plan(plan):
+  """ Validate a move plan.
+  Returns a list of human readable problems, empty if the plan is safe to
+  apply: no two sources share a target, and no pending move would overwrite
+  an existing file.
+  """
+  problems = []
+  sources  = defaultdict(list)
+  for src, dst in plan:
+    sources[os.path.normcase(os.path.abspath(dst))].append(src)
+  for dst, srcs in sorted(sources.items()):
+    if len(srcs) > 1:
+      problems.append('%s <- %s' % (dst, ', '.join(srcs)))
+  for src, dst in plan:
+    if os.path.exists(src) and os.path.exists(dst):
+      problems.append('%s already exists (source %s)' % (dst, src))
+  return problems
+
+
+def pending(plan):
+  """ Return the moves of a plan that have not been applied yet.
+  """
+  return [(src, dst) for src, dst in plan if os.path.exists(src)]
+
+
+def move(srcdst):
+  src, dst = srcdst
+  os.rename(src, dst)  # <- preferred
+  #copyfile(src, dst)  # <- only when folders are read-only
+  return dst
+
+
+def fix(wrl):
+  """ Fix the texture reference in `wrl`; returns `wrl` when that failed.
+  """
+  path, wrlname = os.path.split(wrl)
+  return None if updatewrl(path, wrlname) else wrl
+
+
+def apply_plan(plan, jobs=None, resume=False):
+  """ Apply the pending moves of a plan on a thread pool, then fix the
+  texture reference of each moved .wrl file that has its .jpg in the plan
+  (matched on file name: the .jpg may have gone to the other folder).
+  With `resume`, the .wrl targets moved by an earlier, interrupted run are
+  fixed as well.
+  Returns the lists of .wrl files that could not be fixed and of .wrl files
+  that were skipped because the plan has no .jpg for them.
+  """
+  for fld in (FACES, EARS):
+    if not os.path.isdir(fld):
+      os.makedirs(fld)
+
+  todo     = pending(plan)
+  textures = set(os.path.basename(dst) for src, dst in plan if dst.endswith('.jpg'))
+  pool    = ThreadPool(processes=jobs or multiprocessing.cpu_count())
+  try:
+    moved = set(pool.map(move, todo))
+    wrl   = [dst for src, dst in plan if dst.endswith('.wrl') and
+             (dst in moved or resume and os.path.exists(dst))]
+    notexture = [f for f in wrl if os.path.basename(f)[:-4]+'.jpg' not in textures]
+    failed    = pool.map(fix, [f for f in wrl if f not in notexture])
+    # updatewrl leaves a file that already points at its .jpg alone and
+    # reports it as failed: only report the files moved in this run
+    notfixed  = [f for f in failed if f and f in moved]
+  finally:
+    pool.close()
+    pool.join()
+  return notfixed, notexture
+
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('folder', nargs='?', default='.')
+  parser.add_argument('-n', '--dry-run', action='store_true',
+                      help='print the move plan, do not touch any file')
+  parser.add_argument('-j', '--jobs', type=int, default=None,
+                      help='number of worker threads (default: #cpus)')
+  parser.add_argument('-p', '--plan', default='preprocess1.plan',
+                      help='plan file, kept while a run is incomplete')
+  parser.add_argument('-r', '--resume', action='store_true',
+                      help='resume the interrupted run recorded in the plan file')
+  args = parser.parse_args()
+
+  if args.resume and not os.path.isfile(args.plan):
+    print('No plan file %s to resume' % args.plan, file=sys.stderr)
+    return 1
+  if not args.resume and os.path.isfile(args.plan):
+    print('%s is left from an interrupted run: resume it with --resume, '
+          'or remove it to start over' % args.plan, file=sys.stderr)
+    return 1
+
+  plan     = load_plan(args.plan) if args.resume else make_plan(args.folder)
+  problems = check_plan(plan)
+  todo     = pending(plan)
+
+  if args.dry_run:
+    for src, dst in todo:
+      print('%s -> %s' % (src, dst))
+    print('%d of %d moves pending' % (len(todo), len(plan)), file=sys.stderr)
+
+  if problems:
+    print('Conflicting moves in plan:', file=sys.stderr)
+    print('  ' + '\n  '.join(problems), file=sys.stderr)
+    return 1
+  if args.dry_run:
+    return 0
+
+  if args.resume:
+    print('Resuming %s: %d of %d moves pending' % (args.plan, len(todo), len(plan)))
+  else:
+    save_plan(plan, args.plan)
+  notfixed, notexture = apply_plan(plan, args.jobs, args.resume)
+  os.remove(args.plan)  # applied completely, nothing left to resume
+
   # -- report files in which texture definition could not be found
-  
+
   if len(notfixed):
-    print 'Failed to fix texture in:'
-    print '  ' + '\n  '.join(notfixed)
+    print('Failed to fix texture in:')
+    print('  ' + '\n  '.join(notfixed))
+  if len(notexture):
+    print('No .jpg texture found, not fixed:')
+    print('  ' + '\n  '.join(notexture))
+  return 0
 
 
 
 if __name__ == '__main__':
-  fld = sys.argv[1] if len(sys.argv)>1 else '.'
-  main(fld)
-
-
+  sys.exit(main())
@@ -3,6 +3,7 @@ import math
 
 num_classes = 85742  # 10572
 initializer = 'glorot_normal'
+weight_decay = 5e-4
 # initializer = tf.keras.initializers.TruncatedNormal(
 #     mean=0.0, stddev=0.05, seed=None)
 # initializer = tf.keras.initializers.VarianceScaling(
@@ -10,34 +11,58 @@ initializer = 'glorot_normal'
 
 
 class Arcfacelayer(tf.keras.layers.Layer):
-    def __init__(self, output_dim=num_classes, s=64., m=0.50):
+    def __init__(self, output_dim=num_classes, s=64., m=0.50, sample_rate=1.0):
+        """
+        :param sample_rate: fraction of the class centers used per step (partial FC). With
+            sample_rate < 1 the classes of the batch plus random negative classes are sampled
+            every step, the layer then returns (logits, labels) where labels index the sampled
+            classes. Must leave more sampled classes than the number of labels in a batch.
+            The weight decay then only covers the sampled class centers of the step.
+        """
         self.output_dim = output_dim
         self.s = s
         self.m = m
-        super(Arcfacelayer, self).__init__()
+        self.sample_rate = sample_rate
+        self.num_sampled = max(1, int(round(output_dim * sample_rate)))
+        # logits and margins stay float32 under a mixed precision policy
+        super(Arcfacelayer, self).__init__(dtype='float32')
 
     def build(self, input_shape):
+        # partial FC decays the sampled columns in call, a regularizer on the full kernel
+        # would give every class center a gradient on every step
+        regularizer = tf.keras.regularizers.l2(l=weight_decay) if self.sample_rate >= 1.0 else None
         self.kernel = self.add_weight(name='kernel',
                                       shape=(input_shape[-1],
                                              self.output_dim),
                                       initializer=initializer,
-                                      regularizer=tf.keras.regularizers.l2(
-                                          l=5e-4),
+                                      regularizer=regularizer,
                                       trainable=True)
         super(Arcfacelayer, self).build(input_shape)
 
-    def call(self, embedding, labels):
+    def sample_classes(self, labels):
+        """
+        Sample the class centers of a step: all classes in `labels` plus random negatives.
+        :return: sampled class ids (num_sampled,), labels mapped to positions in the sample
+        """
+        # otherwise top_k drops positive classes and their labels silently map to position 0
+        tf.debugging.assert_less_equal(
+            tf.size(tf.unique(labels)[0]), self.num_sampled,
+            message='more classes in the batch than sampled class centers, raise sample_rate')
+        # positive classes get a score above any random score, so top_k keeps them
+        scores = tf.random.uniform((self.output_dim,))
+        scores = tf.tensor_scatter_nd_update(scores, labels[:, None],
+                                             tf.fill(tf.shape(labels), 2.))
+        _, index = tf.math.top_k(scores, k=self.num_sampled, sorted=False)
+        position = tf.scatter_nd(index[:, None], tf.range(self.num_sampled),
+                                 (self.output_dim,))
+        return index, tf.gather(position, labels)
+
+    def target_logits(self, cos_t):
+        """ s * cos(theta + m) for the (B,) target cosines """
         cos_m = math.cos(self.m)
         sin_m = math.sin(self.m)
         mm = sin_m * self.m  # issue 1
         threshold = math.cos(math.pi - self.m)
-        # inputs and weights norm
-        embedding_norm = tf.norm(embedding, axis=1, keepdims=True)
-        embedding = embedding / embedding_norm
-        weights_norm = tf.norm(self.kernel, axis=0, keepdims=True)
-        weights = self.kernel / weights_norm
-        # cos(theta+m)
-        cos_t = tf.matmul(embedding, weights, name='cos_t')
         cos_t2 = tf.square(cos_t, name='cos_2')
         sin_t2 = tf.subtract(1., cos_t2, name='sin_2')
         sin_t = tf.sqrt(sin_t2, name='sin_t')
@@ -51,18 +76,133 @@ class Arcfacelayer(tf.keras.layers.Layer):
         cond = tf.cast(tf.nn.relu(cond_v, name='if_else'), dtype=tf.bool)
 
         keep_val = self.s * (cos_t - mm)
-        cos_mt_temp = tf.where(cond, cos_mt, keep_val)
-
-        mask = tf.one_hot(labels, depth=self.output_dim, name='one_hot_mask')
-        # mask = tf.squeeze(mask, 1)
-        inv_mask = tf.subtract(1., mask, name='inverse_mask')
+        return tf.where(cond, cos_mt, keep_val)
 
+    def call(self, embedding, labels):
+        sampled = self.sample_rate < 1.0
+        if sampled:
+            index, labels = self.sample_classes(labels)
+            kernel = tf.gather(self.kernel, index, axis=1)
+            self.add_loss(weight_decay * tf.reduce_sum(tf.square(kernel)))
+        else:
+            kernel = self.kernel
+        # inputs and weights norm
+        embedding_norm = tf.norm(embedding, axis=1, keepdims=True)
+        embedding = embedding / embedding_norm
+        weights_norm = tf.norm(kernel, axis=0, keepdims=True)
+        weights = kernel / weights_norm
+        # cos(theta+m)
+        cos_t = tf.matmul(embedding, weights, name='cos_t')
         s_cos_t = tf.multiply(self.s, cos_t, name='scalar_cos_t')
 
-        output = tf.add(tf.multiply(s_cos_t, inv_mask), tf.multiply(
-            cos_mt_temp, mask), name='arcface_loss_output')
+        # the margin only changes the target logits: compute it on the (B,) target
+        # cosines and write those back, instead of masking full (B, depth) matrices
+        target = tf.stack([tf.range(tf.shape(labels)[0]),
+                           tf.cast(labels, tf.int32)], axis=1)
+        cos_mt_temp = self.target_logits(tf.gather_nd(cos_t, target, name='target_cos_t'))
+
+        output = tf.tensor_scatter_nd_update(s_cos_t, target, cos_mt_temp,
+                                             name='arcface_loss_output')
 
+        if sampled:
+            return output, labels
         return output
 
     def compute_output_shape(self, input_shape):
+        if self.sample_rate < 1.0:
+            return (input_shape[0], self.num_sampled)
         return (input_shape[0], self.output_dim)
+
+
+class ShardedArcfacelayer(Arcfacelayer):
+    """
+    Model parallel ArcFace classifier: the class dimension of the kernel is split over
+    `devices`, each device computes the logits of its classes and the softmax cross entropy
+    is computed from the per-device maxima and sums of exponentials, so the (B, num_classes)
+    logits never exist on one device and every kernel shard only gets its own gradient.
+    call returns (per example cross entropy loss (B,), predicted class (B,)).
+    """
+    def __init__(self, output_dim=num_classes, s=64., m=0.50, devices=None):
+        super(ShardedArcfacelayer, self).__init__(output_dim=output_dim, s=s, m=m)
+        self.devices = devices or ['/cpu:0']
+        num_shards = len(self.devices)
+        self.offsets = [output_dim * k // num_shards for k in range(num_shards + 1)]
+
+    def build(self, input_shape):
+        self.kernels = []
+        for k, device in enumerate(self.devices):
+            with tf.device(device):
+                self.kernels.append(self.add_weight(
+                    name='kernel_%d' % k,
+                    shape=(input_shape[-1], self.offsets[k + 1] - self.offsets[k]),
+                    initializer=initializer,
+                    regularizer=tf.keras.regularizers.l2(l=weight_decay),
+                    trainable=True))
+        tf.keras.layers.Layer.build(self, input_shape)
+
+    def call(self, embedding, labels):
+        embedding_norm = tf.norm(embedding, axis=1, keepdims=True)
+        embedding = embedding / embedding_norm
+        labels = tf.cast(labels, tf.int32)
+        rows = tf.range(tf.shape(labels)[0])
+
+        # local logits, with the margin applied to the targets that fall in the shard
+        logits, local_max, local_argmax, target = [], [], [], []
+        for k, (device, kernel) in enumerate(zip(self.devices, self.kernels)):
+            with tf.device(device):
+                weights = kernel / tf.norm(kernel, axis=0, keepdims=True)
+                cos_t = tf.matmul(embedding, weights)
+                local_labels = labels - self.offsets[k]
+                in_shard = (local_labels >= 0) & (local_labels < kernel.shape[-1])
+                index = tf.stack([rows, tf.where(in_shard, local_labels, 0)], axis=1)
+                target_cos_t = tf.gather_nd(cos_t, index)
+                updates = tf.where(in_shard, self.target_logits(target_cos_t),
+                                   self.s * target_cos_t)
+                output = tf.tensor_scatter_nd_update(self.s * cos_t, index, updates)
+                logits.append(output)
+                local_max.append(tf.reduce_max(output, axis=1))
+                local_argmax.append(tf.argmax(output, axis=1, output_type=tf.int32) +
+                                    self.offsets[k])
+                target.append(tf.where(in_shard, updates, 0.))
+
+        # all-reduce of the maxima, then of the sums of exp(logits - max)
+        local_max = tf.stack(local_max, axis=1)
+        global_max = tf.stop_gradient(tf.reduce_max(local_max, axis=1))
+        sum_exp = []
+        for device, output in zip(self.devices, logits):
+            with tf.device(device):
+                sum_exp.append(tf.reduce_sum(tf.exp(output - global_max[:, None]), axis=1))
+        loss = tf.math.log(tf.add_n(sum_exp)) + global_max - tf.add_n(target)
+
+        best_shard = tf.argmax(local_max, axis=1, output_type=tf.int32)
+        pred = tf.gather_nd(tf.stack(local_argmax, axis=1), tf.stack([rows, best_shard], axis=1))
+        return loss, pred
+
+    def compute_output_shape(self, input_shape):
+        return (input_shape[0],), (input_shape[0],)
+
+
+if __name__ == '__main__':
+    # check the sharded classifier against Arcfacelayer on logical CPU devices
+    cpu = tf.config.experimental.list_physical_devices('CPU')[0]
+    tf.config.experimental.set_virtual_device_configuration(
+        cpu, [tf.config.experimental.VirtualDeviceConfiguration()] * 4)
+    devices = [d.name for d in tf.config.experimental.list_logical_devices('CPU')]
+    embedding = tf.random.normal((64, 512))
+    labels = tf.random.uniform((64,), 0, 1000, dtype=tf.int32)
+    dense = Arcfacelayer(output_dim=1000)
+    sharded = ShardedArcfacelayer(output_dim=1000, devices=devices)
+    dense(embedding, labels)
+    sharded(embedding, labels)
+    dense.kernel.assign(tf.concat(sharded.kernels, axis=1))
+    with tf.GradientTape(persistent=True) as tape:
+        logits = dense(embedding, labels)
+        dense_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=logits, labels=labels)
+        sharded_loss, pred = sharded(embedding, labels)
+    grad = tape.gradient(dense_loss, dense.kernel)
+    sharded_grad = tf.concat(tape.gradient(sharded_loss, sharded.kernels), axis=1)
+    print('devices:', devices)
+    print('max loss difference:', float(tf.reduce_max(tf.abs(dense_loss - sharded_loss))))
+    print('max gradient difference:', float(tf.reduce_max(tf.abs(grad - sharded_grad))))
+    print('same predictions:', bool(tf.reduce_all(
+        pred == tf.argmax(logits, axis=1, output_type=tf.int32))))
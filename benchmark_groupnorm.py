@@ -0,0 +1,117 @@
+"""
+Microbenchmark of resnet_groupNorm.GroupNormalization against the previous implementation
+(LegacyGroupNormalization below), on the feature map shapes of the ResNet50 backbone.
+Checks that both give the same outputs for the same weights, then times the forward and the
+forward + backward pass.
+
+    python benchmark_groupnorm.py --batch_size 32 --iterations 50
+"""
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+from resnet_groupNorm import GroupNormalization
+
+# (height, width, channels) of the normalized tensors in resnet_groupNorm.ResNet50
+SHAPES = [(112, 112, 64), (56, 56, 64), (28, 28, 128), (14, 14, 256), (7, 7, 512), (512,)]
+
+
+class LegacyGroupNormalization(GroupNormalization):
+    """ GroupNormalization.call as it was before the fused implementation """
+
+    def call(self, inputs, **kwargs):
+        input_shape = tf.keras.backend.int_shape(inputs)
+        tensor_input_shape = tf.keras.backend.shape(inputs)
+
+        # Prepare broadcasting shape.
+        reduction_axes = list(range(len(input_shape)))
+        del reduction_axes[self.axis]
+        broadcast_shape = [1] * len(input_shape)
+        broadcast_shape[self.axis] = input_shape[self.axis] // self.groups
+        broadcast_shape.insert(1, self.groups)
+
+        reshape_group_shape = tf.keras.backend.shape(inputs)
+        group_axes = [reshape_group_shape[i] for i in range(len(input_shape))]
+        group_axes[self.axis] = input_shape[self.axis] // self.groups
+        group_axes.insert(1, self.groups)
+
+        # reshape inputs to new group shape
+        group_shape = [group_axes[0], self.groups] + group_axes[2:]
+        group_shape = tf.keras.backend.stack(group_shape)
+        inputs = tf.keras.backend.reshape(inputs, group_shape)
+
+        group_reduction_axes = list(range(len(group_axes)))
+        group_reduction_axes = group_reduction_axes[2:]
+
+        mean = tf.keras.backend.mean(
+            inputs, axis=group_reduction_axes, keepdims=True)
+        variance = tf.keras.backend.var(
+            inputs, axis=group_reduction_axes, keepdims=True)
+
+        inputs = (inputs - mean) / \
+            (tf.keras.backend.sqrt(variance + self.epsilon))
+
+        # prepare broadcast shape
+        inputs = tf.keras.backend.reshape(inputs, group_shape)
+        outputs = inputs
+
+        # In this case we must explicitly broadcast all parameters.
+        if self.scale:
+            broadcast_gamma = tf.keras.backend.reshape(
+                self.gamma, broadcast_shape)
+            outputs = outputs * broadcast_gamma
+
+        if self.center:
+            broadcast_beta = tf.keras.backend.reshape(
+                self.beta, broadcast_shape)
+            outputs = outputs + broadcast_beta
+
+        outputs = tf.keras.backend.reshape(outputs, tensor_input_shape)
+
+        return outputs
+
+
+def benchmark(layer, x, iterations):
+    forward = tf.function(lambda: layer(x))
+
+    @tf.function
+    def backward():
+        with tf.GradientTape() as tape:
+            tape.watch(x)
+            y = layer(x)
+        return tape.gradient(y, [x] + layer.trainable_weights)
+
+    times = []
+    for fn in (forward, backward):
+        fn()
+        start = time.time()
+        for _ in range(iterations):
+            fn()
+        times.append((time.time() - start) / iterations * 1000)
+    return times
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='GroupNormalization microbenchmark')
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--iterations', default=50, type=int)
+    parser.add_argument('--groups', default=32, type=int)
+    args = parser.parse_args()
+
+    print('%-16s %10s %10s %10s %10s %10s' % ('shape', 'max diff', 'old fwd', 'new fwd',
+                                            'old f+b', 'new f+b'))
+    for shape in SHAPES:
+        x = tf.random.normal((args.batch_size,) + shape)
+        old = LegacyGroupNormalization(groups=args.groups, epsilon=2e-5)
+        new = GroupNormalization(groups=args.groups, epsilon=2e-5)
+        old.build(x.shape)
+        new.build(x.shape)
+        weights = [np.random.normal(1., 0.1, w.shape) for w in old.get_weights()]
+        old.set_weights(weights)
+        new.set_weights(weights)
+        diff = float(tf.reduce_max(tf.abs(old(x) - new(x))))
+        old_times = benchmark(old, x, args.iterations)
+        new_times = benchmark(new, x, args.iterations)
+        print('%-16s %10.2e %8.2fms %8.2fms %8.2fms %8.2fms' % (
+            'x'.join(str(d) for d in shape), diff,
+            old_times[0], new_times[0], old_times[1], new_times[1]))
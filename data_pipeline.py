@@ -0,0 +1,182 @@
+import collections
+import json
+import os
+import sys
+import numpy as np
+import tensorflow as tf
+
+
+def metadata_path(tfrecord_path):
+    """Sidecar metadata file of a converted dataset, e.g. ms1m_train.json
+    next to ms1m_train.tfrecord."""
+    return os.path.splitext(tfrecord_path)[0] + '.json'
+
+
+def write_metadata(tfrecord_path, class_counts, shards, fmt='tfrecord', shuffled=False):
+    """
+    Write the sidecar metadata of a converted dataset.
+    :param tfrecord_path: path of the tfrecord file (or dataset prefix)
+    :param class_counts: number of records per label, indexed by label
+    :param shards: file names of the tfrecord shards, relative to the metadata file
+    :param fmt: 'tfrecord' or 'decoded' (uint8 image shards, see decoded_dataset)
+    :param shuffled: whether the records were shuffled before sharding (convert_dataset
+        --shuffle); otherwise they are ordered by identity and need a large shuffle buffer
+    :return: the metadata dict
+    """
+    class_counts = [int(c) for c in class_counts]
+    meta = {'format': fmt,
+            'shuffled': bool(shuffled),
+            'num_records': sum(class_counts),
+            'num_classes': len(class_counts),
+            'class_counts': class_counts,
+            'shards': list(shards)}
+    with open(metadata_path(tfrecord_path), 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+def read_metadata(tfrecord_path):
+    """
+    Read the sidecar metadata written by convert_dataset.
+    :param tfrecord_path: path of the tfrecord file (or dataset prefix)
+    :return: the metadata dict, shard paths made absolute, or None if there is no metadata
+    """
+    path = metadata_path(tfrecord_path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        meta = json.load(f)
+    folder = os.path.dirname(path)
+    meta['shards'] = [os.path.join(folder, shard) for shard in meta['shards']]
+    meta.setdefault('format', 'tfrecord')
+    meta.setdefault('shuffled', False)
+    return meta
+
+
+def decoded_labels_path(shard_path):
+    """Label array of a pre-decoded image shard, e.g. ms1m_train_decoded.labels.npy."""
+    return os.path.splitext(shard_path)[0] + '.labels.npy'
+
+
+def id_index_path(tfrecord_path):
+    """Identity index of a converted dataset, e.g. ms1m_train_ids.npy."""
+    return os.path.splitext(tfrecord_path)[0] + '_ids.npy'
+
+
+def write_id_index(path, id_ranges):
+    np.save(path, np.asarray(id_ranges, dtype=np.int64))
+
+
+def read_id_index(path):
+    """
+    :return: (num_identities, 2) array, row `label` holds the [start, end) range of the record
+        indices of that identity in the MXNet RecordIO file
+    """
+    return np.load(path)
+
+
+def identity_batches(id_ranges, num_identities, images_per_identity, seed=None):
+    """
+    Identity-balanced sampler: every batch holds `images_per_identity` (K) records of each of
+    `num_identities` (P) random identities. Identities with fewer than K images are sampled
+    with replacement.
+    Needs a random access source for the records, e.g. the MXNet RecordIO file.
+    :param id_ranges: identity index, see read_id_index
+    :return: endless generator of (record indices, labels), both arrays of length P * K
+    """
+    rng = np.random.RandomState(seed)
+    starts = id_ranges[:, 0]
+    sizes = id_ranges[:, 1] - id_ranges[:, 0]
+    valid = np.nonzero(sizes > 0)[0]
+    while True:
+        labels = rng.choice(valid, num_identities, replace=False)
+        offsets = [rng.choice(sizes[label], images_per_identity,
+                              replace=sizes[label] < images_per_identity)
+                   for label in labels]
+        indices = starts[labels, None] + np.array(offsets)
+        yield indices.reshape(-1), np.repeat(labels, images_per_identity)
+
+
+def interleaved_dataset(shards, cycle_length=None):
+    """
+    Read tfrecord shards in parallel. The shard order is reshuffled on every pass and records
+    of `cycle_length` shards (default: all) are interleaved, so a small shuffle buffer is
+    enough when the shards were written with convert_dataset --shuffle.
+    :param shards: list of tfrecord file paths, e.g. read_metadata(...)['shards']
+    :return: tf.data.Dataset of serialized examples
+    """
+    files = tf.data.Dataset.from_tensor_slices(shards).shuffle(len(shards))
+    return files.interleave(tf.data.TFRecordDataset,
+                            cycle_length=cycle_length or len(shards),
+                            num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                            deterministic=False)
+
+
+def decoded_dataset(shards, batch_size, identities_per_batch=None, seed=None):
+    """
+    Batches of pre-decoded images (convert_dataset --decoded). The image shards are memory
+    mapped, every batch is gathered from them directly, so no JPEG decoding is needed; the
+    page cache keeps the hot part of the shards in memory.
+    :param shards: image shard paths, e.g. read_metadata(...)['shards']
+    :param batch_size: images per batch
+    :param identities_per_batch: if set, batches are identity-balanced (see identity_batches)
+        with batch_size // identities_per_batch images per identity; otherwise records are
+        drawn in a random order that is reshuffled every epoch
+    :return: endless tf.data.Dataset of (uint8 RGB images (batch, 112, 112, 3), int32 labels)
+    """
+    images = [np.load(shard, mmap_mode='r') for shard in shards]
+    labels = np.concatenate([np.load(decoded_labels_path(shard)) for shard in shards])
+    offsets = np.cumsum([0] + [len(x) for x in images])
+
+    def gather(indices):
+        indices = np.sort(indices)
+        batch = np.empty((len(indices),) + images[0].shape[1:], dtype=np.uint8)
+        shard = np.searchsorted(offsets, indices, side='right') - 1
+        for k in np.unique(shard):
+            selected = shard == k
+            batch[selected] = images[k][indices[selected] - offsets[k]]
+        return batch, labels[indices]
+
+    if identities_per_batch:
+        # identity ranges over the rows sorted by label
+        order = np.argsort(labels, kind='stable')
+        ends = np.cumsum(np.bincount(labels))
+        id_ranges = np.stack([ends - np.bincount(labels), ends], axis=1)
+        sampler = identity_batches(id_ranges, identities_per_batch,
+                                   batch_size // identities_per_batch, seed)
+        dataset = tf.data.Dataset.from_generator(lambda: (order[i] for i, _ in sampler),
+                                                 output_types=tf.int64, output_shapes=(None,))
+    else:
+        dataset = tf.data.Dataset.range(len(labels)).shuffle(len(labels), seed=seed)
+        dataset = dataset.repeat().batch(batch_size, drop_remainder=True)
+
+    def load(indices):
+        img, label = tf.numpy_function(gather, [indices], [tf.uint8, tf.int32])
+        img.set_shape((None,) + images[0].shape[1:])
+        label.set_shape((None,))
+        return img, label
+
+    return dataset.map(load, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+
+def build_metadata(tfrecord_path):
+    """
+    Write the sidecar metadata for an existing tfrecord file. This reads the whole file once;
+    files written by convert_dataset already come with their metadata.
+    """
+    features = {'label': tf.io.FixedLenFeature([], tf.int64)}
+    dataset = tf.data.TFRecordDataset(tfrecord_path)
+    dataset = dataset.map(lambda example: tf.io.parse_single_example(example, features)['label'],
+                          num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    class_counts = collections.Counter()
+    for labels in dataset.batch(10000):
+        class_counts.update(labels.numpy().tolist())
+    num_classes = max(class_counts) + 1 if class_counts else 0
+    return write_metadata(tfrecord_path, [class_counts[c] for c in range(num_classes)],
+                          [os.path.basename(tfrecord_path)])
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        meta = build_metadata(path)
+        print('%s: %d records, %d classes' % (path, meta['num_records'], meta['num_classes']))
@@ -0,0 +1,186 @@
+"""
+Local embedding service around train_model().resnet (or a SavedModel from export_embedding.py).
+
+Requests are single 112x112 images or normal maps (BGR / xyz channels, values 0..255). They
+are queued, coalesced into batches of up to `max_batch_size` by a worker thread, which waits at
+most `max_latency_ms` after the first request of a batch for more requests, and answered with
+L2 normalized 512-d embeddings through futures.
+
+Load generator benchmark, with and without batching:
+
+    python embedding_service.py --checkpoint output/ckpt/weights_step-52000 --clients 16
+"""
+import argparse
+import collections
+import importlib
+import threading
+import time
+from concurrent.futures import Future
+import cv2
+import numpy as np
+import tensorflow as tf
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+
+class EmbeddingService(object):
+    def __init__(self, model, max_batch_size=32, max_latency_ms=5., image_size=112,
+                 metrics_window=10000):
+        """
+        :param model: callable, normalized float images (n, 112, 112, 3) -> embeddings (n, 512)
+        :param max_batch_size: maximum number of requests per model call
+        :param max_latency_ms: how long the first request of a batch waits for more requests
+        :param metrics_window: number of recent requests the latency percentiles are computed on
+        """
+        self.model = tf.function(
+            lambda x: model(x, training=False) if isinstance(model, tf.keras.Model) else model(x),
+            input_signature=[tf.TensorSpec((None, image_size, image_size, 3), tf.float32)])
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.
+        self.image_size = image_size
+        self.requests = queue.Queue()
+        self.latencies = collections.deque(maxlen=metrics_window)
+        self.batch_sizes = collections.deque(maxlen=metrics_window)
+        self.lock = threading.Lock()
+        self.worker = threading.Thread(target=self._run, name='embedding-worker')
+        self.worker.daemon = True
+        self.worker.start()
+
+    def preprocess(self, image):
+        image = np.asarray(image)
+        if image.ndim == 2:
+            image = np.repeat(image[:, :, None], 3, axis=2)
+        if image.shape[:2] != (self.image_size, self.image_size):
+            image = cv2.resize(image, (self.image_size, self.image_size))
+        return (image.astype(np.float32) - 127.5) * 0.0078125
+
+    def embed(self, image):
+        """
+        :param image: (h, w, 3) image or normal map with values 0..255, resized if needed
+        :return: concurrent.futures.Future of the L2 normalized embedding
+        """
+        future = Future()
+        self.requests.put((time.time(), self.preprocess(image), future))
+        return future
+
+    def embed_batch(self, images):
+        """ convenience: embeddings of several images, submitted as individual requests """
+        return np.stack([f.result() for f in [self.embed(image) for image in images]])
+
+    def close(self):
+        self.requests.put(None)
+        self.worker.join()
+
+    def _next_batch(self):
+        first = self.requests.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first[0] + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                request = self.requests.get(timeout=timeout) if timeout > 0 else \
+                    self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                self.requests.put(None)  # stop after this batch
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                embeddings = self.model(np.stack([image for _, image, _ in batch])).numpy()
+                embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            done = time.time()
+            with self.lock:
+                self.batch_sizes.append(len(batch))
+                self.latencies.extend(done - submitted for submitted, _, _ in batch)
+            for (_, _, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
+
+    def metrics(self):
+        """ :return: dict with p50/p99/mean request latency in ms and the mean batch size """
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = np.array(self.batch_sizes)
+        if len(latencies) == 0:
+            return {'requests': 0}
+        return {'requests': len(latencies),
+                'p50_ms': np.percentile(latencies, 50),
+                'p99_ms': np.percentile(latencies, 99),
+                'mean_ms': latencies.mean(),
+                'mean_batch_size': batch_sizes.mean()}
+
+
+def load_model(module='resnet', checkpoint=None, savedmodel=None):
+    """ embedding model: a SavedModel written by export_embedding.py, or train_model().resnet """
+    if savedmodel:
+        loaded = tf.saved_model.load(savedmodel)
+        # keeps a reference to `loaded`, which owns the variables
+        return lambda x: loaded.signatures['serving_default'](x)['embedding']
+    tmodel = importlib.import_module(module).train_model()
+    tmodel(tf.zeros((1, 112, 112, 3)), tf.zeros((1,), dtype=tf.int32))
+    if checkpoint:
+        tmodel.load_weights(checkpoint).expect_partial()
+    return tmodel.resnet
+
+
+def load_test(service, images, clients, requests_per_client):
+    """
+    Closed loop load generator: `clients` threads send requests one after the other.
+    :return: requests per second
+    """
+    def client(k):
+        for i in range(requests_per_client):
+            service.embed(images[(k + i) % len(images)]).result()
+
+    threads = [threading.Thread(target=client, args=(k,)) for k in range(clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return clients * requests_per_client / (time.time() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Embedding service load test')
+    parser.add_argument('--model', default='resnet',
+                        choices=['resnet', 'resnet_batchRenorm', 'resnet_groupNorm'],
+                        help='module that defines train_model')
+    parser.add_argument('--checkpoint', default=None, help='weights saved by the training scripts')
+    parser.add_argument('--savedmodel', default=None, help='SavedModel from export_embedding.py')
+    parser.add_argument('--clients', default=16, type=int, help='concurrent clients')
+    parser.add_argument('--requests', default=20, type=int, help='requests per client')
+    parser.add_argument('--max_batch_size', default=32, type=int)
+    parser.add_argument('--max_latency_ms', default=5., type=float)
+    args = parser.parse_args()
+
+    model = load_model(args.model, args.checkpoint, args.savedmodel)
+    images = np.random.RandomState(0).randint(0, 256, (64, 112, 112, 3)).astype(np.uint8)
+
+    print('%-12s %10s %10s %10s %12s' % ('batching', 'req/sec', 'p50', 'p99', 'batch size'))
+    for max_batch_size in (1, args.max_batch_size):
+        service = EmbeddingService(model, max_batch_size, args.max_latency_ms)
+        service.embed(images[0]).result()  # trace the model
+        service.latencies.clear()
+        service.batch_sizes.clear()
+        throughput = load_test(service, images, args.clients, args.requests)
+        m = service.metrics()
+        service.close()
+        print('%-12s %10.1f %8.1fms %8.1fms %12.1f' % (
+            'max %d' % max_batch_size, throughput, m['p50_ms'], m['p99_ms'], m['mean_batch_size']))
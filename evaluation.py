@@ -1,17 +1,67 @@
+import argparse
+import collections
+import csv
+import glob
+import importlib
+import multiprocessing
+import os
+import re
 import numpy as np
 import pickle
 import cv2
 import tensorflow as tf
-import mxnet as mx
 import datetime
-import sklearn
+from concurrent.futures import ThreadPoolExecutor
+import sklearn.preprocessing
 from sklearn.model_selection import KFold
-from sklearn.decomposition import PCA
-from scipy import interpolate
-from resnet import ResNet50, train_model
 
 
-def calculate_roc(thresholds, embeddings1, embeddings2, actual_issame, nrof_folds=10, pca=0):
+def fold_distances(embeddings1, embeddings2, folds, pca_values=(0,), workers=None):
+    """
+    Squared distances of all pairs, for every fold and PCA dimension (0: no PCA). For pca > 0
+    the pairs are projected on the principal axes of the train pairs of the fold and normalized.
+    The axes come from one eigendecomposition of the train scatter matrix per fold, shared by
+    all PCA dimensions; the folds run in parallel threads (numpy releases the GIL).
+    :param folds: list of (train_set, test_set) index arrays
+    :return: dict pca -> list with one distance array per fold
+    """
+    diff = np.subtract(embeddings1, embeddings2)
+    dists = {0: [np.sum(np.square(diff), 1)] * len(folds)}
+    dims = sorted(set(pca for pca in pca_values if pca > 0))
+
+    def scatter(indices):
+        embed = np.concatenate((embeddings1[indices], embeddings2[indices]), axis=0)
+        return embed.T.dot(embed), embed.sum(0), len(embed)
+
+    def project(fold):
+        # train scatter = scatter of all pairs - scatter of the test pairs
+        _, test_set = fold
+        test_gram, test_sum, test_count = scatter(test_set)
+        count = total[2] - test_count
+        mean = (total[1] - test_sum) / count
+        _, axes = np.linalg.eigh(total[0] - test_gram - count * np.outer(mean, mean))  # ascending
+        axes = axes[:, ::-1][:, :dims[-1]]
+        embed1 = (embeddings1 - mean).dot(axes)
+        embed2 = (embeddings2 - mean).dot(axes)
+        return [np.sum(np.square(sklearn.preprocessing.normalize(embed1[:, :pca]) -
+                                 sklearn.preprocessing.normalize(embed2[:, :pca])), 1)
+                for pca in dims]
+
+    if dims:
+        print('doing pca %s on %d folds' % (dims, len(folds)))
+        total = scatter(np.concatenate(folds[0]))
+        with ThreadPoolExecutor(workers) as pool:
+            per_fold = list(pool.map(project, folds))
+        for k, pca in enumerate(dims):
+            dists[pca] = [fold[k] for fold in per_fold]
+    return {pca: dists[pca] for pca in pca_values}
+
+
+def calculate_roc(thresholds, embeddings1, embeddings2, actual_issame, nrof_folds=10, pca=0,
+                  dists=None, workers=None):
+    """
+    :param dists: optional distances per fold, fold_distances(...)[pca] for the KFold splits
+    """
     assert (embeddings1.shape[0] == embeddings2.shape[0])
     assert (embeddings1.shape[1] == embeddings2.shape[1])
     nrof_pairs = min(len(actual_issame), embeddings1.shape[0])
@@ -22,56 +72,49 @@ def calculate_roc(thresholds, embeddings1, embeddings2, actual_issame, nrof_fold
     fprs = np.zeros((nrof_folds, nrof_thresholds))
     accuracy = np.zeros((nrof_folds))
     indices = np.arange(nrof_pairs)
-    # print('pca', pca)
-
-    if pca == 0:
-        diff = np.subtract(embeddings1, embeddings2)
-        dist = np.sum(np.square(diff), 1)
-        # for i in range(len(dist)):
-        #     dist[i] = abs(np.dot(embeddings1[i], embeddings2[i]))
-
-    for fold_idx, (train_set, test_set) in enumerate(k_fold.split(indices)):
-        # print('train_set', train_set)
-        # print('test_set', test_set)
-        if pca > 0:
-            print('doing pca on', fold_idx)
-            embed1_train = embeddings1[train_set]
-            embed2_train = embeddings2[train_set]
-            _embed_train = np.concatenate((embed1_train, embed2_train), axis=0)
-            # print(_embed_train.shape)
-            pca_model = PCA(n_components=pca)
-            pca_model.fit(_embed_train)
-            embed1 = pca_model.transform(embeddings1)
-            embed2 = pca_model.transform(embeddings2)
-            embed1 = sklearn.preprocessing.normalize(embed1)
-            embed2 = sklearn.preprocessing.normalize(embed2)
-            # print(embed1.shape, embed2.shape)
-            diff = np.subtract(embed1, embed2)
-            dist = np.sum(np.square(diff), 1)
-            # for i in range(len(dist)):
-            #     dist[i] = abs(np.dot(embed1[i], embed1[i]))
+    folds = list(k_fold.split(indices))
+    if dists is None:
+        dists = fold_distances(embeddings1, embeddings2, folds, (pca,), workers)[pca]
 
+    for fold_idx, ((train_set, test_set), dist) in enumerate(zip(folds, dists)):
         # Find the best threshold for the fold
-        acc_train = np.zeros((nrof_thresholds))
-        for threshold_idx, threshold in enumerate(thresholds):
-            _, _, acc_train[threshold_idx] = calculate_accuracy(
-                threshold, dist[train_set], actual_issame[train_set])
+        _, _, acc_train = calculate_accuracies(thresholds, dist[train_set], actual_issame[train_set])
         best_threshold_index = np.argmax(acc_train)
         print('best_threshold_index', best_threshold_index,
               acc_train[best_threshold_index])
-        for threshold_idx, threshold in enumerate(thresholds):
-            tprs[fold_idx, threshold_idx], fprs[fold_idx, threshold_idx], _ = calculate_accuracy(threshold,
-                                                                                                 dist[test_set],
-                                                                                                 actual_issame[
-                                                                                                     test_set])
-        _, _, accuracy[fold_idx] = calculate_accuracy(thresholds[best_threshold_index], dist[test_set],
-                                                      actual_issame[test_set])
+        tprs[fold_idx], fprs[fold_idx], acc_test = calculate_accuracies(
+            thresholds, dist[test_set], actual_issame[test_set])
+        accuracy[fold_idx] = acc_test[best_threshold_index]
 
     tpr = np.mean(tprs, 0)
     fpr = np.mean(fprs, 0)
     return tpr, fpr, accuracy
 
 
+def threshold_counts(thresholds, dist, actual_issame):
+    """
+    Accepted pairs (dist < threshold) for a whole threshold grid, from one sort of the distances:
+    the number of accepted pairs is a searchsorted position, cumulative sums of the labels give
+    the true and false accepts.
+    :return: true accepts and false accepts per threshold, number of same and different pairs
+    """
+    order = np.argsort(dist, kind='stable')
+    issame = np.asarray(actual_issame, dtype=bool)[order]
+    tp = np.concatenate(([0], np.cumsum(issame)))
+    fp = np.concatenate(([0], np.cumsum(~issame)))
+    accepted = np.searchsorted(dist[order], thresholds, side='left')
+    return tp[accepted], fp[accepted], tp[-1], fp[-1]
+
+
+def calculate_accuracies(thresholds, dist, actual_issame):
+    """ calculate_accuracy for every threshold: arrays of tpr, fpr and accuracy """
+    tp, fp, n_same, n_diff = threshold_counts(thresholds, dist, actual_issame)
+    tpr = tp / float(n_same) if n_same else np.zeros(len(tp))
+    fpr = fp / float(n_diff) if n_diff else np.zeros(len(fp))
+    acc = (tp + n_diff - fp) / float(dist.size)
+    return tpr, fpr, acc
+
+
 def calculate_accuracy(threshold, dist, actual_issame):
     predict_issame = np.less(dist, threshold)
     # predict_issame = np.less(threshold, dist)
@@ -101,7 +144,6 @@ def calculate_val(thresholds, embeddings1, embeddings2, actual_issame, far_targe
     assert (embeddings1.shape[0] == embeddings2.shape[0])
     assert (embeddings1.shape[1] == embeddings2.shape[1])
     nrof_pairs = min(len(actual_issame), embeddings1.shape[0])
-    nrof_thresholds = len(thresholds)
     k_fold = KFold(n_splits=nrof_folds, shuffle=False)
 
     val = np.zeros(nrof_folds)
@@ -114,13 +156,12 @@ def calculate_val(thresholds, embeddings1, embeddings2, actual_issame, far_targe
     for fold_idx, (train_set, test_set) in enumerate(k_fold.split(indices)):
 
         # Find the threshold that gives FAR = far_target
-        far_train = np.zeros(nrof_thresholds)
-        for threshold_idx, threshold in enumerate(thresholds):
-            _, far_train[threshold_idx] = calculate_val_far(
-                threshold, dist[train_set], actual_issame[train_set])
+        _, far_train = calculate_val_fars(thresholds, dist[train_set], actual_issame[train_set])
         if np.max(far_train) >= far_target:
-            f = interpolate.interp1d(far_train, thresholds, kind='slinear')
-            threshold = f(far_target)
+            # far_train is non-decreasing with long runs of equal values; interpolate between
+            # the smallest thresholds of every FAR value (interp1d rejects duplicate x)
+            far_unique, first = np.unique(far_train, return_index=True)
+            threshold = np.interp(far_target, far_unique, thresholds[first])
         else:
             threshold = 0.0
 
@@ -133,6 +174,12 @@ def calculate_val(thresholds, embeddings1, embeddings2, actual_issame, far_targe
     return val_mean, val_std, far_mean
 
 
+def calculate_val_fars(thresholds, dist, actual_issame):
+    """ calculate_val_far for every threshold: arrays of val and far """
+    tp, fp, n_same, n_diff = threshold_counts(thresholds, dist, actual_issame)
+    return tp / float(n_same), fp / float(n_diff)
+
+
 def calculate_val_far(threshold, dist, actual_issame):
     predict_issame = np.less(dist, threshold)
     true_accept = np.sum(np.logical_and(predict_issame, actual_issame))
@@ -158,27 +205,73 @@ def evaluate(embeddings, actual_issame, nrof_folds=10, pca=0):
     return tpr, fpr, accuracy, val, val_std, far
 
 
-def load_bin(path, image_size):
-    bins, issame_list = pickle.load(
-        open(path, 'rb'), encoding='bytes')
-    data_list = []
-    for _ in [0, 1]:
-        data = np.empty(
-            (len(issame_list) * 2, image_size[0], image_size[1], 3))
-        data_list.append(data)
-    for i in range(len(issame_list) * 2):
-        _bin = bins[i]
-        img = mx.image.imdecode(_bin).asnumpy()
-        img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-        for flip in [0, 1]:
-            if flip == 1:
-                img = np.fliplr(img)
-            data_list[flip][i, ...] = img
-        i += 1
-        if i % 1000 == 0:
-            print('loading bin', i)
-    print(data_list[0].shape)
-    return data_list, issame_list
+def pca_sweep(embeddings, actual_issame, pca_values, nrof_folds=10, workers=None):
+    """
+    Verification accuracy for several PCA dimensions (0: no PCA), from one PCA per fold.
+    VAL does not depend on the PCA and is computed once.
+    :return: dict pca -> (accuracy mean, accuracy std), and val, val_std, far
+    """
+    thresholds = np.arange(0, 4, 0.01)
+    embeddings1 = embeddings[0::2]
+    embeddings2 = embeddings[1::2]
+    actual_issame = np.asarray(actual_issame)
+    nrof_pairs = min(len(actual_issame), embeddings1.shape[0])
+    folds = list(KFold(n_splits=nrof_folds, shuffle=False).split(np.arange(nrof_pairs)))
+    dists = fold_distances(embeddings1, embeddings2, folds, pca_values, workers)
+    accuracies = {}
+    for pca in pca_values:
+        _, _, accuracy = calculate_roc(thresholds, embeddings1, embeddings2, actual_issame,
+                                       nrof_folds=nrof_folds, pca=pca, dists=dists[pca])
+        accuracies[pca] = (np.mean(accuracy), np.std(accuracy))
+    val, val_std, far = calculate_val(np.arange(0, 4, 0.001), embeddings1, embeddings2,
+                                      actual_issame, 1e-3, nrof_folds=nrof_folds)
+    return accuracies, val, val_std, far
+
+
+def bin_cache_paths(path, image_size):
+    """ decoded image cache of a verification .bin, e.g. lfw_112x112.npy and lfw_issame.npy """
+    prefix = os.path.splitext(path)[0]
+    return prefix + '_%dx%d.npy' % tuple(image_size), prefix + '_issame.npy'
+
+
+def _save_npy(path, array):
+    # write to a temporary file first, a concurrent reader never sees a partial cache
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, array)
+    os.replace(path + '.tmp', path)
+
+
+def decode_image(_bin, image_size):
+    img = cv2.imdecode(np.frombuffer(_bin, dtype=np.uint8), cv2.IMREAD_COLOR)  # BGR
+    if img.shape[:2] != tuple(image_size):
+        img = cv2.resize(img, (image_size[1], image_size[0]))
+    return img
+
+
+def load_bin(path, image_size, cache=True, workers=None):
+    """
+    Load a verification benchmark (lfw.bin, cfp_fp.bin, ...). The JPEGs are decoded with cv2 in
+    a thread pool into one uint8 BGR array, which is cached next to the .bin (see
+    bin_cache_paths) and memory mapped on later loads.
+    :return: [images, horizontally flipped images (a view)], issame_list
+    """
+    images_path, issame_path = bin_cache_paths(path, image_size)
+    if cache and os.path.exists(images_path) and os.path.exists(issame_path):
+        data = np.load(images_path, mmap_mode='r')
+        issame_list = np.load(issame_path).tolist()
+    else:
+        with open(path, 'rb') as f:
+            bins, issame_list = pickle.load(f, encoding='bytes')
+        data = np.empty((len(issame_list) * 2, image_size[0], image_size[1], 3), dtype=np.uint8)
+        with ThreadPoolExecutor(workers) as pool:
+            for i, img in enumerate(pool.map(lambda _bin: decode_image(_bin, image_size),
+                                             bins[:len(data)])):
+                data[i] = img
+        if cache:
+            _save_npy(images_path, data)
+            _save_npy(issame_path, np.asarray(issame_list, dtype=bool))
+    print(data.shape)
+    return [data, data[:, :, ::-1]], issame_list
 
 
 def data_iter(datasets, batch_size):
@@ -187,56 +280,67 @@ def data_iter(datasets, batch_size):
         yield datasets[i:min(i + batch_size, data_num), ...]
 
 
+def embedding_batches(images, batch_size):
+    '''
+    tf.data pipeline over uint8 images (an array or the memory map from load_bin): normalized
+    float32 batches with the horizontally flipped images appended, so that both passes of
+    test() run in one model call. Batches are prepared in parallel and prefetched.
+    '''
+    def load(start):
+        return np.ascontiguousarray(images[start:start + batch_size])
+
+    def fetch(start):
+        batch = tf.numpy_function(load, [start], tf.uint8)
+        batch.set_shape((None,) + images.shape[1:])
+        batch = (tf.cast(batch, tf.float32) - 127.5) * 0.0078125
+        return tf.concat([batch, tf.reverse(batch, axis=[2])], axis=0)
+
+    dataset = tf.data.Dataset.range(0, len(images), batch_size)
+    dataset = dataset.map(fetch, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def extract_embeddings(images, batch_size, model):
+    '''
+    :param images: uint8 BGR images, data_set[0][0] from load_bin
+    :param model: Keras model or callable, normalized float32 images -> embeddings
+    :return: sum of the embeddings of every image and its flipped copy (float32, not
+        normalized), mean embedding norm (XNorm), seconds spent in the model
+    '''
+    if isinstance(model, tf.keras.Model):
+        model = tf.function(lambda x, keras_model=model: keras_model(x, training=False))
+    embeddings = None
+    _xnorm = 0.0
+    time_consumed = 0.0
+    start = 0
+    for batch in embedding_batches(images, batch_size):
+        time0 = datetime.datetime.now()
+        _embeddings = np.asarray(model(batch), dtype=np.float32)
+        time_consumed += (datetime.datetime.now() - time0).total_seconds()
+        if embeddings is None:
+            embeddings = np.empty((len(images), _embeddings.shape[1]), dtype=np.float32)
+        n = len(_embeddings) // 2
+        embeddings[start:start + n] = _embeddings[:n] + _embeddings[n:]
+        _xnorm += float(np.linalg.norm(_embeddings, axis=1).sum())
+        start += n
+    return embeddings, _xnorm / (2 * start), time_consumed
+
+
 def test(data_set, batch_size, model):
     '''
     referenc official implementation [insightface](https://github.com/deepinsight/insightface)
-    :param data_set:
-    :param batch_size:
+    :param data_set: (data_list, issame_list) from load_bin; the flipped images of data_list[1]
+        are recomputed on the fly from data_list[0]
+    :param batch_size: images per batch, the model sees twice as many (with the flipped ones)
     :param model:
     :return:
     '''
     data_list = data_set[0]
     issame_list = data_set[1]
-    embeddings_list = []
-    time_consumed = 0.0
-    for i in range(len(data_list)):
-        datas = data_list[i]
-        embeddings = None
-        for idx, data in enumerate(data_iter(datas, batch_size)):
-            data_tmp = data.copy()    # fix issues #4
-            data_tmp -= 127.5
-            data_tmp *= 0.0078125
-            data_tmp = tf.cast(data_tmp, tf.float32)
-            time0 = datetime.datetime.now()
-            _embeddings = model(data_tmp)
-            time_now = datetime.datetime.now()
-            diff = time_now - time0
-            time_consumed += diff.total_seconds()
-            if embeddings is None:
-                embeddings = np.zeros((datas.shape[0], _embeddings.shape[1]))
-            try:
-                embeddings[idx * batch_size:min((idx + 1) *
-                                                batch_size, datas.shape[0]), ...] = _embeddings
-            except ValueError:
-                print('idx*batch_size value is %d min((idx+1)*batch_size, datas.shape[0]) %d, batch_size %d, data.shape[0] %d' %
-                      (idx * batch_size, min((idx + 1) * batch_size, datas.shape[0]), batch_size, datas.shape[0]))
-                print('embedding shape is ', _embeddings.shape)
-        embeddings_list.append(embeddings)
-
-    _xnorm = 0.0
-    _xnorm_cnt = 0
-    for embed in embeddings_list:
-        for i in range(embed.shape[0]):
-            _em = embed[i]
-            _norm = np.linalg.norm(_em)
-            # print(_em.shape, _norm)
-            _xnorm += _norm
-            _xnorm_cnt += 1
-    _xnorm /= _xnorm_cnt
+    embeddings, _xnorm, time_consumed = extract_embeddings(data_list[0], batch_size, model)
 
     acc1 = 0.0
     std1 = 0.0
-    embeddings = embeddings_list[0] + embeddings_list[1]
     embeddings = sklearn.preprocessing.normalize(embeddings)
     print(embeddings.shape)
     print('infer time', time_consumed)
@@ -256,21 +360,126 @@ def ver_test(data_set, dataset_name, batch_size, model):
         print('[%s]Accuracy: %1.5f+-%1.5f' % (dataset_name[i], acc2, std2))
 
 
-tmodel = train_model()
-dataset = []
-dataset_name = []
-dataset.append(load_bin('dataset/faces_webface_112x112/lfw.bin', [112, 112]))
-dataset_name.append('lfw')
-dataset.append(
-    load_bin('dataset/faces_webface_112x112/cfp_ff.bin', [112, 112]))
-dataset_name.append('cfp_ff')
-dataset.append(
-    load_bin('dataset/faces_webface_112x112/cfp_fp.bin', [112, 112]))
-dataset_name.append('cfp_fp')
-dataset.append(
-    load_bin('dataset/faces_webface_112x112/agedb_30.bin', [112, 112]))
-dataset_name.append('agedb_30')
-for i in [52000]:
-    tmodel.load_weights('output/ckpt/weights_step-%d' % i)
-    model = tmodel.resnet
-    ver_test(dataset, dataset_name, 16, model)
+def checkpoint_step(checkpoint):
+    """ training step in a checkpoint name like weights_step-52000, for sorting """
+    match = re.search(r'(\d+)$', checkpoint)
+    return int(match.group(1)) if match else -1
+
+
+def find_checkpoints(pattern):
+    """ checkpoint prefixes matching a glob like output/ckpt/weights_step-*, by step """
+    checkpoints = set(path[:-len('.index')] for path in glob.glob(pattern + '.index'))
+    return sorted(checkpoints, key=lambda checkpoint: (checkpoint_step(checkpoint), checkpoint))
+
+
+def benchmark_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+_worker = {}
+
+
+def _init_worker(module, benchmarks, image_size, threads):
+    """ builds the model and memory maps the decoded benchmarks, once per worker process """
+    if threads:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(threads)
+    tmodel = importlib.import_module(module).train_model()
+    tmodel(tf.zeros((1, image_size[0], image_size[1], 3)), tf.zeros((1,), dtype=tf.int32))
+    _worker['tmodel'] = tmodel
+    # one trace for all checkpoints, load_weights assigns to the same variables
+    _worker['embed'] = tf.function(lambda x: tmodel.resnet(x, training=False))
+    _worker['data_sets'] = [(benchmark_name(path), load_bin(path, image_size))
+                            for path in benchmarks]
+
+
+def evaluate_checkpoint(checkpoint, batch_size):
+    """ :return: one result row (dict) per benchmark """
+    _worker['tmodel'].load_weights(checkpoint).expect_partial()
+    rows = []
+    for name, data_set in _worker['data_sets']:
+        embeddings, xnorm, infer_time = extract_embeddings(data_set[0][0], batch_size,
+                                                           _worker['embed'])
+        _, _, accuracy, val, val_std, far = evaluate(
+            sklearn.preprocessing.normalize(embeddings), data_set[1], nrof_folds=10)
+        rows.append({'checkpoint': checkpoint, 'benchmark': name,
+                     'accuracy': np.mean(accuracy), 'accuracy_std': np.std(accuracy),
+                     'val': val, 'val_std': val_std, 'far': far,
+                     'xnorm': xnorm, 'infer_time': infer_time})
+    return rows
+
+
+def evaluate_checkpoints(module, checkpoints, benchmarks, batch_size=64, workers=1,
+                         image_size=(112, 112)):
+    """
+    Evaluate every checkpoint on every verification benchmark. The benchmarks are decoded once
+    into the load_bin cache here; `workers` spawned processes memory map that cache (the page
+    cache shares it) and evaluate the checkpoints in parallel.
+    :return: list of result rows, ordered by checkpoint and benchmark
+    """
+    for path in benchmarks:
+        load_bin(path, image_size)
+    threads = max(1, (os.cpu_count() or 1) // workers) if workers > 1 else None
+    initargs = (module, benchmarks, image_size, threads)
+    if workers <= 1:
+        _init_worker(*initargs)
+        results = [evaluate_checkpoint(checkpoint, batch_size) for checkpoint in checkpoints]
+    else:
+        with multiprocessing.get_context('spawn').Pool(workers, _init_worker, initargs) as pool:
+            results = pool.starmap(evaluate_checkpoint,
+                                   [(checkpoint, batch_size) for checkpoint in checkpoints])
+    return [row for rows in results for row in rows]
+
+
+def write_results(rows, path):
+    columns = ['checkpoint', 'benchmark', 'accuracy', 'accuracy_std', 'val', 'val_std', 'far',
+               'xnorm', 'infer_time']
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def print_results(rows):
+    print('%-40s %-10s %18s %18s %10s %10s' % ('checkpoint', 'benchmark', 'accuracy',
+                                               'VAL@FAR=1e-3', 'XNorm', 'infer (s)'))
+    for row in rows:
+        print('%-40s %-10s %10.5f+-%.5f %10.5f+-%.5f %10.3f %10.1f' % (
+            os.path.basename(row['checkpoint']), row['benchmark'], row['accuracy'],
+            row['accuracy_std'], row['val'], row['val_std'], row['xnorm'], row['infer_time']))
+    mean_accuracy = collections.defaultdict(list)
+    for row in rows:
+        mean_accuracy[row['checkpoint']].append(row['accuracy'])
+    best = max(mean_accuracy, key=lambda checkpoint: np.mean(mean_accuracy[checkpoint]))
+    print('best checkpoint (mean accuracy %.5f): %s' % (np.mean(mean_accuracy[best]), best))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Verification accuracy of training checkpoints')
+    parser.add_argument('--model', default='resnet',
+                        choices=['resnet', 'resnet_batchRenorm', 'resnet_groupNorm'],
+                        help='module that defines train_model')
+    parser.add_argument('--checkpoints', default='output/ckpt/weights_step-*',
+                        help='glob of checkpoint prefixes')
+    parser.add_argument('--benchmarks', nargs='+',
+                        default=['dataset/faces_webface_112x112/%s.bin' % name
+                                 for name in ['lfw', 'cfp_ff', 'cfp_fp', 'agedb_30']],
+                        help='.bin verification benchmarks')
+    parser.add_argument('--batch_size', default=64, type=int, help='images per batch')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='worker processes, each evaluates whole checkpoints; at most one per '
+                             'core or GPU')
+    parser.add_argument('--output', default='output/evaluation.csv', help='results table (csv)')
+    args = parser.parse_args()
+
+    checkpoints = find_checkpoints(args.checkpoints)
+    if not checkpoints:
+        raise ValueError('no checkpoints match ' + args.checkpoints)
+    print('%d checkpoints, %d benchmarks' % (len(checkpoints), len(args.benchmarks)))
+    rows = evaluate_checkpoints(args.model, checkpoints, args.benchmarks, args.batch_size,
+                                args.workers)
+    if os.path.dirname(args.output) and not os.path.exists(os.path.dirname(args.output)):
+        os.makedirs(os.path.dirname(args.output))
+    write_results(rows, args.output)
+    print_results(rows)
+    print('saved ' + args.output)
@@ -0,0 +1,186 @@
+"""
+Export a trained ResNet50 (resnet.py or resnet_batchRenorm.py) as a lean embedding-only
+SavedModel for inference.
+
+Every BatchNormalization / BatchRenorm layer is an affine transform at inference time, so
+- conv + BN pairs (conv0/bn0, conv1/bn2, conv2/bn3, conv1sc/sc) become one conv with bias,
+- bn1 -> Dropout -> Reshape -> E_DenseLayer -> fc1 becomes one Dense layer,
+- the stride 1 ZeroPadding2D + 'valid' convs become 'same' convs.
+The BN in front of each residual unit (stageX_unitY_bn1) stays: it is followed by zero padding,
+so it can not be folded into the next conv exactly.
+GroupNormalization (resnet_groupNorm.py) normalizes with per image statistics and can not be
+folded.
+
+    python export_embedding.py --model resnet_batchRenorm \
+        --checkpoint output/ckpt/weights_step-52000 --output output/embedding_savedmodel
+"""
+import argparse
+import importlib
+import time
+import numpy as np
+import tensorflow as tf
+
+units = [3, 4, 14, 3]
+
+
+def bn_affine(bn):
+    """ scale and shift of a (renorm) batch normalization layer at inference time """
+    scale = 1. / np.sqrt(bn.moving_variance.numpy() + bn.epsilon)
+    if bn.gamma is not None:
+        scale = scale * bn.gamma.numpy()
+    shift = -bn.moving_mean.numpy() * scale
+    if bn.beta is not None:
+        shift = shift + bn.beta.numpy()
+    return scale, shift
+
+
+def fold_conv(conv, bn):
+    """ kernel and bias of `conv` followed by `bn` """
+    scale, shift = bn_affine(bn)
+    weights = conv.get_weights()
+    kernel = weights[0] * scale
+    bias = weights[1] * scale + shift if conv.use_bias else shift
+    return [kernel, bias]
+
+
+def folded_conv(x, conv, bn):
+    padding = 'valid'
+    if conv.strides == (1, 1) and conv.kernel_size == (3, 3):
+        padding = 'same'  # replaces the preceding ZeroPadding2D((1, 1))
+    else:
+        if conv.kernel_size == (3, 3):
+            x = tf.keras.layers.ZeroPadding2D(padding=(1, 1), name=conv.name + '_pad')(x)
+    layer = tf.keras.layers.Conv2D(conv.filters, conv.kernel_size, strides=conv.strides,
+                                   padding=padding, use_bias=True, name=conv.name)
+    x = layer(x)
+    layer.set_weights(fold_conv(conv, bn))
+    return x
+
+
+def copy_prelu(x, prelu):
+    layer = tf.keras.layers.PReLU(shared_axes=prelu.shared_axes, name=prelu.name)
+    x = layer(x)
+    layer.set_weights(prelu.get_weights())
+    return x
+
+
+def copy_bn(x, bn):
+    """ plain inference BN with the statistics of `bn`, without the renorm weights """
+    layer = tf.keras.layers.BatchNormalization(epsilon=bn.epsilon, name=bn.name)
+    x = layer(x, training=False)
+    layer.set_weights([bn.gamma.numpy() if bn.gamma is not None else np.ones(bn.moving_mean.shape),
+                       bn.beta.numpy() if bn.beta is not None else np.zeros(bn.moving_mean.shape),
+                       bn.moving_mean.numpy(), bn.moving_variance.numpy()])
+    return x
+
+
+def fold_resnet(resnet):
+    """
+    :param resnet: trained ResNet50 model, e.g. train_model().resnet
+    :return: functional model with the same embeddings and no foldable BN layers
+    """
+    get = resnet.get_layer
+    for layer in resnet.layers:
+        if 'Normalization' in layer.__class__.__name__ and \
+                not isinstance(layer, tf.keras.layers.BatchNormalization):
+            raise ValueError('%s (%s) can not be folded' % (layer.name, layer.__class__.__name__))
+
+    img_input = tf.keras.layers.Input(shape=resnet.input_shape[1:])
+    x = folded_conv(img_input, get('conv0'), get('bn0'))
+    x = copy_prelu(x, get('prelu0'))
+
+    for i in range(len(units)):
+        for j in range(units[i]):
+            name = 'stage%d_unit%d' % (i + 1, j + 1)
+            shortcut = x
+            x = copy_bn(x, get(name + '_bn1'))
+            x = folded_conv(x, get(name + '_conv1'), get(name + '_bn2'))
+            x = copy_prelu(x, get(name + '_relu1'))
+            x = folded_conv(x, get(name + '_conv2'), get(name + '_bn3'))
+            if j == 0:
+                shortcut = folded_conv(shortcut, get(name + '_conv1sc'), get(name + '_sc'))
+            x = x + shortcut
+
+    # bn1 -> Reshape -> E_DenseLayer -> fc1 as a single Dense layer
+    dense = get('E_DenseLayer')
+    kernel, bias = dense.get_weights()
+    scale, shift = bn_affine(get('bn1'))
+    channels = scale.shape[0]
+    # the flattened (h, w, c) input repeats the channel scale and shift every `channels`
+    scale = np.tile(scale, kernel.shape[0] // channels)
+    shift = np.tile(shift, kernel.shape[0] // channels)
+    bias = bias + shift.dot(kernel)
+    kernel = kernel * scale[:, None]
+    scale, shift = bn_affine(get('fc1'))
+    kernel = kernel * scale
+    bias = bias * scale + shift
+
+    x = tf.keras.layers.Flatten(name='reshapelayer')(x)
+    layer = tf.keras.layers.Dense(kernel.shape[1], name='embedding')
+    x = layer(x)
+    layer.set_weights([kernel, bias])
+    return tf.keras.models.Model(img_input, x, name='resnet50_folded')
+
+
+def randomize_bn_statistics(resnet, seed=0):
+    """ random BN statistics and parameters, to check the folding without a checkpoint """
+    rng = np.random.RandomState(seed)
+    for layer in resnet.layers:
+        if isinstance(layer, tf.keras.layers.BatchNormalization):
+            layer.set_weights([rng.uniform(0.5, 1.5, w.shape) if 'variance' in v.name or
+                               'gamma' in v.name else rng.normal(0., 0.1, w.shape)
+                               for v, w in zip(layer.weights, layer.get_weights())])
+
+
+def latency(model, images, runs):
+    fn = tf.function(lambda x: model(x, training=False))
+    fn(images)
+    times = []
+    for _ in range(runs):
+        time0 = time.time()
+        fn(images).numpy()
+        times.append(time.time() - time0)
+    return np.median(times) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a BN folded embedding SavedModel')
+    parser.add_argument('--model', default='resnet', choices=['resnet', 'resnet_batchRenorm'],
+                        help='module that defines train_model')
+    parser.add_argument('--checkpoint', default=None, help='weights saved by the training scripts')
+    parser.add_argument('--output', default='output/embedding_savedmodel', help='SavedModel folder')
+    parser.add_argument('--batch_size', default=16, type=int, help='batch size for the latency')
+    parser.add_argument('--runs', default=20, type=int, help='timed runs for the latency')
+    args = parser.parse_args()
+
+    tmodel = importlib.import_module(args.model).train_model()
+    tmodel(tf.zeros((1, 112, 112, 3)), tf.zeros((1,), dtype=tf.int32))
+    if args.checkpoint:
+        tmodel.load_weights(args.checkpoint).expect_partial()
+    else:
+        print('No checkpoint, using random weights and BN statistics')
+        randomize_bn_statistics(tmodel.resnet)
+    resnet = tmodel.resnet
+    folded = fold_resnet(resnet)
+    print('layers: %d -> %d' % (len(resnet.layers), len(folded.layers)))
+
+    images = tf.random.uniform((args.batch_size, 112, 112, 3), -1., 1.)
+    reference = resnet(images, training=False).numpy()
+    embeddings = folded(images).numpy()
+    diff = np.abs(reference - embeddings).max()
+    cos = np.sum(reference * embeddings, 1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(embeddings, axis=1))
+    print('max abs difference: %g (embedding norm %.3f), min cosine similarity: %.7f' %
+          (diff, np.linalg.norm(reference, axis=1).mean(), cos.min()))
+    if cos.min() < 0.9999:
+        raise ValueError('folded embeddings differ from the trained model')
+
+    before = latency(resnet, images, args.runs)
+    after = latency(folded, images, args.runs)
+    print('latency (batch %d): %.1f ms -> %.1f ms (%.2fx)' %
+          (args.batch_size, before, after, before / after))
+
+    serve = tf.function(lambda x: {'embedding': folded(x, training=False)},
+                        input_signature=[tf.TensorSpec((None, 112, 112, 3), tf.float32)])
+    tf.saved_model.save(folded, args.output, signatures=serve)
+    print('saved to ' + args.output)
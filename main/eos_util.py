@@ -77,20 +77,60 @@ def load_wrl(sourcefile):
     return tvi, vertices
 
 
+def clean_mesh(tvi, vertices, tolerance=1e-6):
+    """ Remove invalid, degenerate and duplicate parts of a triangle mesh
+    Drops faces with out of range indices, merges vertices that are equal after quantisation
+    to `tolerance`, drops faces that became degenerate (repeated vertex or zero area) and
+    duplicate faces (same vertices in any order), and removes unreferenced vertices.
+    :param tvi: Fx3 index of vertices
+    :param vertices: Vx3 x,y,z coordinates of vertices
+    :param tolerance: vertices closer than this (per coordinate) are merged, 0 merges exact
+        duplicates only
+    :return tvi: Fx3 int32 array, index of vertices
+    :return vertices: Vx3 array of the referenced vertices, in the dtype of the input
+    """
+    vertices = np.asarray(vertices)
+    vertices = vertices.reshape(-1, 3) if vertices.size else np.zeros((0, 3), np.float32)
+    tvi = np.asarray(tvi, dtype=np.int64).reshape(-1, 3)
+
+    # faces with invalid vertex indices
+    tvi = tvi[((tvi >= 0) & (tvi < len(vertices))).all(axis=1)]
+
+    # merge duplicate vertices
+    key = np.round(vertices / tolerance) if tolerance > 0 else vertices
+    _, first, inverse = np.unique(key, axis=0, return_index=True, return_inverse=True)
+    vertices = vertices[first]
+    tvi = inverse.reshape(-1)[tvi]
+
+    # degenerate faces: repeated vertices or zero area (same arithmetic as normal_pattern)
+    tvi = tvi[(tvi[:, 0] != tvi[:, 1]) & (tvi[:, 1] != tvi[:, 2]) & (tvi[:, 0] != tvi[:, 2])]
+    v1 = vertices[tvi[:, 2]] - vertices[tvi[:, 0]]
+    v2 = vertices[tvi[:, 1]] - vertices[tvi[:, 0]]
+    cross = np.cross(v1, v2)
+    tvi = tvi[cross[:, 0] * cross[:, 0] + cross[:, 1] * cross[:, 1] + cross[:, 2] * cross[:, 2] > 0]
+
+    # duplicate faces, keep the first occurrence with its orientation
+    _, first = np.unique(np.sort(tvi, axis=1), axis=0, return_index=True)
+    tvi = tvi[np.sort(first)]
+
+    # unreferenced vertices
+    used = np.unique(tvi)
+    lookup = np.zeros(len(vertices), dtype=np.int64)
+    lookup[used] = np.arange(len(used))
+    return lookup[tvi].astype(np.int32), vertices[used]
+
+
 def normal_pattern(tvi, vertices, img_size, show_bar=False):
 
+    tvi, vertices = clean_mesh(tvi, vertices)
+
     counter = 1
     tvi_len = len(tvi) + 2
 
     # Find min and max value for x,y coordinates
-    minimum = []
-    maximum = []
-    for element in vertices:
-        minimum.append(min(element))
-        maximum.append(max(element))
-    print("Minimum: " + str(min(minimum)) + " - Maximum: " + str(max(maximum)))
-    original_size = max(maximum) - min(minimum)
-    min_value = min(minimum)
+    print("Minimum: " + str(vertices.min()) + " - Maximum: " + str(vertices.max()))
+    original_size = vertices.max() - vertices.min()
+    min_value = vertices.min()
     ratio = original_size / img_size
     print("Original size: " + str(original_size) + " - Image size: " + str(img_size) + " - Ratio: " + str(ratio))
 
@@ -110,13 +150,9 @@ def normal_pattern(tvi, vertices, img_size, show_bar=False):
             sys.stdout.flush()
             counter += 1
 
-        try:
-            x = [(vertices[triangle[0]][0]), (vertices[triangle[1]][0]), (vertices[triangle[2]][0])]
-            y = [(vertices[triangle[0]][1]), (vertices[triangle[1]][1]), (vertices[triangle[2]][1])]
-            z = [(vertices[triangle[0]][2]), (vertices[triangle[1]][2]), (vertices[triangle[2]][2])]
-        except IndexError:
-            print("IndexError: list index out of range")
-            print(triangle)
+        x = [(vertices[triangle[0]][0]), (vertices[triangle[1]][0]), (vertices[triangle[2]][0])]
+        y = [(vertices[triangle[0]][1]), (vertices[triangle[1]][1]), (vertices[triangle[2]][1])]
+        z = [(vertices[triangle[0]][2]), (vertices[triangle[1]][2]), (vertices[triangle[2]][2])]
 
         # x[0], z[0] = rotate(4, x[0], z[0])
         # x[1], z[1] = rotate(4, x[1], z[1])
@@ -141,22 +177,18 @@ def normal_pattern(tvi, vertices, img_size, show_bar=False):
 
                     if mx < img_size + 20 and my < img_size + 20:
                         # Determine the cross product of the two vectors:
-                        if len_cross == 0:
-                            imx[mx][my] = 0
-                            imy[mx][my] = 0
-                            imz[mx][my] = 0
-                        else:
-                            imx[mx][my] = (-cross[0] / len_cross)
-                            imy[mx][my] = (-cross[1] / len_cross)
-                            imz[mx][my] = (-cross[2] / len_cross)
-                            # print(imy[mx, my])
-                            # print("(" + str(mx) + "/" + str(my) + ")")
-                            if imx[mx, my] < min_x:
-                                min_x = imx[mx, my]
-                            if imy[mx, my] < min_y:
-                                min_y = imy[mx, my]
-                            if imz[mx, my] < min_z:
-                                min_z = imz[mx, my]
+                        # (degenerate triangles were removed by clean_mesh)
+                        imx[mx][my] = (-cross[0] / len_cross)
+                        imy[mx][my] = (-cross[1] / len_cross)
+                        imz[mx][my] = (-cross[2] / len_cross)
+                        # print(imy[mx, my])
+                        # print("(" + str(mx) + "/" + str(my) + ")")
+                        if imx[mx, my] < min_x:
+                            min_x = imx[mx, my]
+                        if imy[mx, my] < min_y:
+                            min_y = imy[mx, my]
+                        if imz[mx, my] < min_z:
+                            min_z = imz[mx, my]
                     else:
                         print("Warning: out of range. Pixel skipped")
                         return None, None, None
@@ -0,0 +1,258 @@
+import argparse
+import os
+import sys
+import numpy as np
+
+# PLY scalar types and their numpy equivalents (without byte order)
+PLY_TYPES = {'char': 'i1', 'int8': 'i1',
+             'uchar': 'u1', 'uint8': 'u1',
+             'short': 'i2', 'int16': 'i2',
+             'ushort': 'u2', 'uint16': 'u2',
+             'int': 'i4', 'int32': 'i4',
+             'uint': 'u4', 'uint32': 'u4',
+             'float': 'f4', 'float32': 'f4',
+             'double': 'f8', 'float64': 'f8'}
+
+PLY_FORMATS = {'ascii': None,
+               'binary_little_endian': '<',
+               'binary_big_endian': '>'}
+
+
+def read_header(fid):
+    """ Parse the header of a PLY file
+    :param fid: file opened in binary mode, positioned at the start of the file
+    :return fmt: 'ascii', 'binary_little_endian' or 'binary_big_endian'
+    :return elements: list of (name, count, properties), where properties is a list of
+        (name, type) for scalar properties and (name, (count_type, item_type)) for lists
+    """
+    if fid.readline().strip() != b'ply':
+        raise ValueError('Not a PLY file: ' + str(getattr(fid, 'name', fid)))
+
+    fmt = None
+    elements = []
+    for line in fid:
+        words = line.decode('ascii').split()
+        if not words or words[0] in ('comment', 'obj_info'):
+            continue
+        if words[0] == 'end_header':
+            break
+        if words[0] == 'format':
+            fmt = words[1]
+            if fmt not in PLY_FORMATS:
+                raise ValueError('Unsupported PLY format: ' + fmt)
+        elif words[0] == 'element':
+            elements.append((words[1], int(words[2]), []))
+        elif words[0] == 'property':
+            if words[1] == 'list':
+                elements[-1][2].append((words[4], (words[2], words[3])))
+            else:
+                elements[-1][2].append((words[2], words[1]))
+    else:
+        raise ValueError('PLY header without end_header')
+    return fmt, elements
+
+
+def _split_rows(props, rows):
+    """ Split an (n, row_length) array of uniform rows into its properties """
+    data = {}
+    col = 0
+    for name, t in props:
+        if isinstance(t, tuple):
+            k = int(rows[0, col]) if len(rows) else 0
+            data[name] = rows[:, col + 1:col + 1 + k].astype(PLY_TYPES[t[1]])
+            col += 1 + k
+        else:
+            data[name] = rows[:, col].astype(PLY_TYPES[t])
+            col += 1
+    return data
+
+
+def _parse_ascii(body, elements):
+    # one vectorised pass to turn the complete body into numbers
+    values = np.fromstring(body, dtype=np.float64, sep=' ')
+    pos = 0
+    result = {}
+    for name, count, props in elements:
+        if count == 0 or not any(isinstance(t, tuple) for _, t in props):
+            n = len(props)
+            result[name] = _split_rows(props, values[pos:pos + n * count].reshape(count, n))
+            pos += n * count
+            continue
+
+        # assume all list properties have the same length as in the first row,
+        # then verify; faces of a triangle mesh always take this path
+        cols, n = [], 0
+        for _, t in props:
+            if isinstance(t, tuple):
+                cols.append(n)
+                n += 1 + int(values[pos + n])
+            else:
+                n += 1
+        rows = values[pos:pos + n * count]
+        if len(rows) == n * count:
+            rows = rows.reshape(count, n)
+            if all((rows[:, c] == rows[0, c]).all() for c in cols):
+                result[name] = _split_rows(props, rows)
+                pos += n * count
+                continue
+
+        # mixed list lengths (e.g. triangles and quads): row by row
+        data = dict((pname, []) for pname, _ in props)
+        for _ in range(count):
+            for pname, t in props:
+                if isinstance(t, tuple):
+                    k = int(values[pos])
+                    data[pname].append(values[pos + 1:pos + 1 + k].astype(PLY_TYPES[t[1]]))
+                    pos += 1 + k
+                else:
+                    data[pname].append(values[pos])
+                    pos += 1
+        for pname, t in props:
+            if not isinstance(t, tuple):
+                data[pname] = np.array(data[pname], dtype=PLY_TYPES[t])
+        result[name] = data
+    return result
+
+
+def _parse_binary(buf, offset, elements, order):
+    result = {}
+    for name, count, props in elements:
+        if not any(isinstance(t, tuple) for _, t in props):
+            dt = np.dtype([(pname, order + PLY_TYPES[t]) for pname, t in props])
+            rows = np.frombuffer(buf, dtype=dt, count=count, offset=offset)
+            result[name] = dict((pname, rows[pname]) for pname, _ in props)
+            offset += dt.itemsize * count
+            continue
+
+        # read the list lengths of the first row and assume every row has the same layout
+        fields = []
+        p = offset
+        for pname, t in props:
+            if isinstance(t, tuple):
+                ct = np.dtype(order + PLY_TYPES[t[0]])
+                k = int(np.frombuffer(buf, dtype=ct, count=1, offset=p)[0]) if count else 0
+                it = np.dtype(order + PLY_TYPES[t[1]])
+                fields.append((pname + '_count', ct))
+                fields.append((pname, it, (k,)))
+                p += ct.itemsize + k * it.itemsize
+            else:
+                dt = np.dtype(order + PLY_TYPES[t])
+                fields.append((pname, dt))
+                p += dt.itemsize
+        dt = np.dtype(fields)
+        if offset + dt.itemsize * count <= len(buf):
+            rows = np.frombuffer(buf, dtype=dt, count=count, offset=offset)
+            if all((rows[pname + '_count'] == rows[pname].shape[1]).all()
+                   for pname, t in props if isinstance(t, tuple)):
+                result[name] = dict((pname, rows[pname]) for pname, _ in props)
+                offset += dt.itemsize * count
+                continue
+
+        # mixed list lengths: row by row
+        data = dict((pname, []) for pname, _ in props)
+        for _ in range(count):
+            for pname, t in props:
+                if isinstance(t, tuple):
+                    ct = np.dtype(order + PLY_TYPES[t[0]])
+                    it = np.dtype(order + PLY_TYPES[t[1]])
+                    k = int(np.frombuffer(buf, dtype=ct, count=1, offset=offset)[0])
+                    offset += ct.itemsize
+                    data[pname].append(np.frombuffer(buf, dtype=it, count=k, offset=offset))
+                    offset += k * it.itemsize
+                else:
+                    dt = np.dtype(order + PLY_TYPES[t])
+                    data[pname].append(np.frombuffer(buf, dtype=dt, count=1, offset=offset)[0])
+                    offset += dt.itemsize
+        for pname, t in props:
+            if not isinstance(t, tuple):
+                data[pname] = np.array(data[pname])
+        result[name] = data
+    return result
+
+
+def read_ply(sourcefile):
+    """ Read all elements of an ASCII or binary PLY file
+    :param sourcefile: filename of ply file
+    :return: dict mapping element name to a dict of property name to array. List properties
+        of equal length are returned as (count, length) arrays, otherwise as a list of arrays.
+        Binary files are read without copying the data.
+    """
+    with open(sourcefile, 'rb') as fid:
+        fmt, elements = read_header(fid)
+        offset = fid.tell()
+        fid.seek(0)
+        buf = fid.read()
+
+    if fmt == 'ascii':
+        return _parse_ascii(buf[offset:], elements)
+    return _parse_binary(buf, offset, elements, PLY_FORMATS[fmt])
+
+
+def load_ply(sourcefile):
+    """ Load a triangle mesh from a PLY file
+    :param sourcefile: filename of ply file
+    :return tvi: Fx3 int32 array, index of vertices (same as eos_util.load_wrl)
+    :return vertices: Vx3 float32 array, x,y,z coordinates of vertices
+    """
+    elements = read_ply(sourcefile)
+    vertex = elements['vertex']
+    vertices = np.stack([vertex['x'], vertex['y'], vertex['z']], axis=1).astype(np.float32)
+    face = elements.get('face', {})
+    indices = face.get('vertex_indices', face.get('vertex_index', np.zeros((0, 3))))
+    tvi = np.asarray(indices, dtype=np.int32).reshape(-1, 3)
+    return tvi, vertices
+
+
+def write_ply(targetfile, tvi, vertices, binary=True):
+    """ Write a triangle mesh to a PLY file
+    :param targetfile: filename of ply file
+    :param tvi: Fx3 array, index of vertices
+    :param vertices: Vx3 array, x,y,z coordinates of vertices
+    :param binary: write binary little endian (default) or ascii PLY
+    """
+    vertices = np.asarray(vertices, dtype='<f4').reshape(-1, 3)
+    tvi = np.asarray(tvi, dtype='<i4').reshape(-1, 3)
+
+    header = ('ply\n'
+              'format %s 1.0\n'
+              'element vertex %d\n'
+              'property float x\n'
+              'property float y\n'
+              'property float z\n'
+              'element face %d\n'
+              'property list uchar int vertex_indices\n'
+              'end_header\n') % ('binary_little_endian' if binary else 'ascii',
+                                 len(vertices), len(tvi))
+
+    with open(targetfile, 'wb') as fid:
+        fid.write(header.encode('ascii'))
+        if binary:
+            fid.write(vertices.tobytes())
+            faces = np.empty(len(tvi), dtype=[('count', 'u1'), ('vertex_indices', '<i4', (3,))])
+            faces['count'] = 3
+            faces['vertex_indices'] = tvi
+            fid.write(faces.tobytes())
+        else:
+            np.savetxt(fid, vertices, fmt='%f')
+            np.savetxt(fid, np.hstack([np.full((len(tvi), 1), 3, dtype=np.int32), tvi]), fmt='%d')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert PLY meshes to binary PLY')
+    parser.add_argument('files', nargs='+', help='PLY files to convert')
+    parser.add_argument('-o', '--output', default='.', help='output folder')
+    parser.add_argument('--ascii', action='store_true', help='write ascii instead of binary PLY')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    for filename in args.files:
+        target = os.path.join(args.output, os.path.basename(filename))
+        if os.path.abspath(target) == os.path.abspath(filename):
+            print("Skipping " + filename + ": output would overwrite input")
+            continue
+        tvi, vertices = load_ply(filename)
+        write_ply(target, tvi, vertices, binary=not args.ascii)
+        print(filename + " -> " + target + " (" + str(len(vertices)) + " vertices, " +
+              str(len(tvi)) + " faces)")
+    sys.exit(0)
@@ -0,0 +1,124 @@
+import argparse
+import os
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def depth_to_points(depth, depth_scale=None):
+    """ Turn a depth map (like the 3DFace/*.npy files) into a point cloud
+    :param depth: HxW array, 0 marks background
+    :param depth_scale: factor from depth values to pixel units, defaults to half the image width
+        (the 3DFace depth maps are normalised to [0, 1])
+    :return points: Nx3 float64 array, x = column, y = row, z = scaled depth
+    """
+    if depth_scale is None:
+        depth_scale = 0.5 * max(depth.shape)
+    rows, cols = np.nonzero(depth)
+    return np.stack([cols, rows, depth[rows, cols] * depth_scale], axis=1).astype(np.float64)
+
+
+def load_points(sourcefile, depth_scale=None):
+    """ Load a point cloud from a .npy file holding either Nx3 points or an HxW depth map """
+    data = np.load(sourcefile, allow_pickle=True)
+    if data.ndim == 2 and data.shape[1] == 3:
+        return data.astype(np.float64)
+    return depth_to_points(data, depth_scale)
+
+
+def estimate_normals(points, k=16, chunk_size=65536, view_dir=(0., 0., 1.)):
+    """ Estimate per-point normals with k-nearest-neighbour PCA
+    The neighbours are found with a KD-tree; the covariance matrices of all neighbourhoods are
+    eigen-decomposed in batches, the normal is the eigenvector of the smallest eigenvalue.
+    :param points: Nx3 array
+    :param k: number of neighbours, including the point itself
+    :param chunk_size: number of points per batch, bounds memory use for large scans
+    :param view_dir: normals are flipped to point towards this direction (the scanner)
+    :return normals: Nx3 float64 array of unit normals
+    """
+    points = np.asarray(points, dtype=np.float64)
+    k = min(k, len(points))
+    _, neighbours = cKDTree(points).query(points, k=k)
+    neighbours = neighbours.reshape(len(points), k)
+
+    normals = np.empty_like(points)
+    for start in range(0, len(points), chunk_size):
+        nb = points[neighbours[start:start + chunk_size]]          # (n, k, 3)
+        nb = nb - nb.mean(axis=1, keepdims=True)
+        cov = np.einsum('nki,nkj->nij', nb, nb) / k                # (n, 3, 3)
+        _, eigvec = np.linalg.eigh(cov)                            # ascending eigenvalues
+        normals[start:start + chunk_size] = eigvec[:, :, 0]
+
+    flip = normals.dot(np.asarray(view_dir, dtype=np.float64)) < 0
+    normals[flip] *= -1
+    return normals
+
+
+def normal_map(points, normals, img_size):
+    """ Splat point normals into x, y and z normal images
+    Points are projected orthographically along z; where several points fall on the same
+    pixel the one closest to the viewer (largest z) is kept (z-buffer). Empty pixels with
+    covered neighbours get the mean of their 3x3 neighbourhood, which closes the gaps when
+    the image has a higher resolution than the point cloud.
+    :param points: Nx3 array
+    :param normals: Nx3 array of unit normals
+    :param img_size: width and height of the images
+    :return: x, y and z normal images with values 0..255, indexed [x, y] as in
+        eos_util.normal_pattern (use eos_util.saveImage to store them)
+    """
+    points = np.asarray(points)
+    min_value = points[:, :2].min()
+    ratio = (points[:, :2].max() - min_value) / (img_size - 1)
+    if ratio == 0:
+        ratio = 1.
+    px = ((points[:, 0] - min_value) / ratio).astype(np.int64)
+    py = ((points[:, 1] - min_value) / ratio).astype(np.int64)
+    pixel = px * img_size + py
+
+    # sort on pixel, then on depth: the last point of every pixel run is the visible one
+    order = np.lexsort((points[:, 2], pixel))
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = pixel[order[1:]] != pixel[order[:-1]]
+    visible = order[last]
+
+    covered = np.zeros(img_size * img_size)
+    covered[pixel[visible]] = 1.
+    covered = covered.reshape(img_size, img_size)
+    count = _sum3x3(covered)
+    holes = (covered == 0) & (count > 0)
+
+    images = []
+    for axis in range(3):
+        img = np.zeros(img_size * img_size)
+        img[pixel[visible]] = (normals[visible, axis] + 1.) * 127.5
+        img = img.reshape(img_size, img_size)
+        img[holes] = _sum3x3(img)[holes] / count[holes]
+        images.append(img)
+    return images[0], images[1], images[2]
+
+
+def _sum3x3(img):
+    """ Sum over the 3x3 neighbourhood of every pixel (zero padded) """
+    padded = np.pad(img, 1)
+    h, w = img.shape
+    return sum(padded[i:i + h, j:j + w] for i in range(3) for j in range(3))
+
+
+if __name__ == "__main__":
+    import eos_util
+
+    parser = argparse.ArgumentParser(description='Normal maps from point clouds or depth maps (.npy)')
+    parser.add_argument('files', nargs='+', help='.npy files')
+    parser.add_argument('-o', '--output', default='.', help='output folder')
+    parser.add_argument('-s', '--size', type=int, default=200, help='image size')
+    parser.add_argument('-k', type=int, default=16, help='number of neighbours for the normal estimation')
+    args = parser.parse_args()
+
+    for filename in args.files:
+        points = load_points(filename)
+        normals = estimate_normals(points, k=args.k)
+        x_normal, y_normal, z_normal = normal_map(points, normals, args.size)
+        name = os.path.splitext(os.path.basename(filename))[0]
+        eos_util.saveImage(os.path.join(args.output, name + "_x.png"), x_normal)
+        eos_util.saveImage(os.path.join(args.output, name + "_y.png"), y_normal)
+        eos_util.saveImage(os.path.join(args.output, name + "_z.png"), z_normal)
+        print(filename + ": " + str(len(points)) + " points")
@@ -0,0 +1,145 @@
+"""
+Post-training int8 quantization of the embedding model for CPU serving.
+
+The trained ResNet50 is BN folded (export_embedding.fold_resnet), calibrated on a few hundred
+aligned 112x112 crops and converted to a full integer TFLite model (float input and output).
+Both models are then compared on the verification benchmarks of evaluation.load_bin, with
+accuracy, latency per image and throughput.
+
+    python quantize_embedding.py --checkpoint output/ckpt/weights_step-52000 \
+        --calibration dataset/faces_webface_112x112/lfw.bin \
+        --benchmarks dataset/faces_webface_112x112/lfw.bin dataset/faces_webface_112x112/cfp_fp.bin
+"""
+import argparse
+import glob
+import importlib
+import os
+import time
+import cv2
+import numpy as np
+import tensorflow as tf
+import evaluation
+from export_embedding import fold_resnet
+
+
+def normalize(images):
+    return (np.asarray(images, dtype=np.float32) - 127.5) * 0.0078125
+
+
+def calibration_images(source, num_images):
+    """
+    :param source: a .bin benchmark file (evaluation.load_bin) or a folder of aligned crops
+    :return: (num_images, 112, 112, 3) BGR images, as in evaluation.load_bin
+    """
+    if source.endswith('.bin'):
+        images = evaluation.load_bin(source, [112, 112])[0][0]
+        rng = np.random.RandomState(0)
+        return images[rng.choice(len(images), min(num_images, len(images)), replace=False)]
+    files = sorted(glob.glob(os.path.join(source, '*.jpg')) + glob.glob(os.path.join(source, '*.png')))
+    images = [cv2.resize(cv2.imread(f), (112, 112)) for f in files[:num_images]]
+    return np.stack(images)
+
+
+def quantize(model, images):
+    """ full integer TFLite model of `model`, calibrated on `images` (BGR, 0..255) """
+    def representative_dataset():
+        for image in images:
+            yield [normalize(image[None])]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    return converter.convert()
+
+
+class TFLiteEmbedding(object):
+    """ callable like the Keras model: normalized float images -> float embeddings """
+
+    def __init__(self, model_content, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_content=model_content, num_threads=num_threads)
+        self.input = self.interpreter.get_input_details()[0]['index']
+        self.output = self.interpreter.get_output_details()[0]['index']
+        self.batch_size = None
+
+    def __call__(self, images):
+        images = np.asarray(images, dtype=np.float32)
+        if images.shape[0] != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input, images.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = images.shape[0]
+        self.interpreter.set_tensor(self.input, images)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output).copy()
+
+
+def timing(model, images, batch_size, runs):
+    """ :return: median latency of one batch in ms, images per second """
+    batch = normalize(images[:batch_size])
+    model(batch)
+    times = []
+    for _ in range(runs):
+        time0 = time.time()
+        np.asarray(model(batch))
+        times.append(time.time() - time0)
+    latency = np.median(times)
+    return latency * 1000, batch_size / latency
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='int8 quantized embedding model')
+    parser.add_argument('--model', default='resnet', choices=['resnet', 'resnet_batchRenorm'],
+                        help='module that defines train_model')
+    parser.add_argument('--checkpoint', required=True, help='weights saved by the training scripts')
+    parser.add_argument('--calibration', required=True,
+                        help='.bin benchmark file or folder of aligned 112x112 crops')
+    parser.add_argument('--num_calibration', default=300, type=int,
+                        help='number of calibration images')
+    parser.add_argument('--benchmarks', nargs='*', default=[], help='.bin verification benchmarks')
+    parser.add_argument('--output', default='output/embedding_int8.tflite', help='TFLite file')
+    parser.add_argument('--batch_size', default=16, type=int, help='batch size for throughput')
+    parser.add_argument('--runs', default=20, type=int, help='timed runs')
+    parser.add_argument('--threads', default=None, type=int, help='TFLite interpreter threads')
+    args = parser.parse_args()
+
+    tmodel = importlib.import_module(args.model).train_model()
+    tmodel(tf.zeros((1, 112, 112, 3)), tf.zeros((1,), dtype=tf.int32))
+    tmodel.load_weights(args.checkpoint).expect_partial()
+    float_model = fold_resnet(tmodel.resnet)
+
+    images = calibration_images(args.calibration, args.num_calibration)
+    print('calibrating on %d images...' % len(images))
+    tflite_model = quantize(float_model, images)
+    if os.path.dirname(args.output) and not os.path.exists(os.path.dirname(args.output)):
+        os.makedirs(os.path.dirname(args.output))
+    with open(args.output, 'wb') as f:
+        f.write(tflite_model)
+    print('saved %s (%.1f MB)' % (args.output, len(tflite_model) / 1e6))
+    int8_model = TFLiteEmbedding(tflite_model, num_threads=args.threads)
+
+    float_fn = tf.function(lambda x: float_model(x, training=False))
+    models = [('float32', lambda x: float_fn(tf.constant(x)).numpy()), ('int8', int8_model)]
+    print('%-10s %14s %14s %14s' % ('model', 'latency (1)', 'latency (%d)' % args.batch_size,
+                                    'images/sec'))
+    for name, model in models:
+        single, _ = timing(model, images, 1, args.runs)
+        batched, throughput = timing(model, images, args.batch_size, args.runs)
+        print('%-10s %12.1fms %12.1fms %14.1f' % (name, single, batched, throughput))
+
+    batch = normalize(images[:args.batch_size])
+    reference, quantized = models[0][1](batch), int8_model(batch)
+    cos = np.sum(reference * quantized, 1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(quantized, axis=1))
+    print('cosine similarity float32 / int8 embeddings: mean %.4f, min %.4f' %
+          (cos.mean(), cos.min()))
+
+    for path in args.benchmarks:
+        data_set = evaluation.load_bin(path, [112, 112])
+        results = []
+        for name, model in models:
+            _, _, acc, std, xnorm = evaluation.test(data_set, args.batch_size, model)
+            results.append(acc)
+            print('[%s] %-8s XNorm: %f Accuracy: %1.5f+-%1.5f' %
+                  (os.path.basename(path), name, xnorm, acc, std))
+        print('[%s] accuracy delta (int8 - float32): %+1.5f' %
+              (os.path.basename(path), results[1] - results[0]))
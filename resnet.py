@@ -1,8 +1,9 @@
 import tensorflow as tf
 import os
-from arcface import Arcfacelayer
+from arcface import Arcfacelayer, ShardedArcfacelayer
 
 bn_axis = -1
+norm_dtype = 'float32'  # normalization stays float32 under a mixed precision policy
 initializer = 'glorot_normal'
 
 
@@ -15,6 +16,7 @@ def residual_unit_v3(input, num_filter, stride, dim_match, name):
                                            #        l=5e-4),
                                            gamma_regularizer=tf.keras.regularizers.l2(
                                                l=5e-4),
+                                           dtype=norm_dtype,
                                            name=name + '_bn1')(input)
     x = tf.keras.layers.ZeroPadding2D(
         padding=(1, 1), name=name + '_conv1_pad')(x)
@@ -34,6 +36,7 @@ def residual_unit_v3(input, num_filter, stride, dim_match, name):
                                            #        l=5e-4),
                                            gamma_regularizer=tf.keras.regularizers.l2(
                                                l=5e-4),
+                                           dtype=norm_dtype,
                                            name=name + '_bn2')(x)
     x = tf.keras.layers.PReLU(name=name + '_relu1',
                               alpha_regularizer=tf.keras.regularizers.l2(
@@ -56,6 +59,7 @@ def residual_unit_v3(input, num_filter, stride, dim_match, name):
                                            #        l=5e-4),
                                            gamma_regularizer=tf.keras.regularizers.l2(
                                                l=5e-4),
+                                           dtype=norm_dtype,
                                            name=name + '_bn3')(x)
     if (dim_match):
         shortcut = input
@@ -76,6 +80,7 @@ def residual_unit_v3(input, num_filter, stride, dim_match, name):
                                                       #       l=5e-4),
                                                       gamma_regularizer=tf.keras.regularizers.l2(
                                                           l=5e-4),
+                                                      dtype=norm_dtype,
                                                       name=name + '_sc')(shortcut)
     return x + shortcut
 
@@ -89,6 +94,7 @@ def get_fc1(input):
                                            #        l=5e-4),
                                            gamma_regularizer=tf.keras.regularizers.l2(
                                                l=5e-4),
+                                           dtype=norm_dtype,
                                            name='bn1')(input)
     x = tf.keras.layers.Dropout(0.4)(x)
     resnet_shape = input.shape
@@ -106,6 +112,7 @@ def get_fc1(input):
                                            epsilon=2e-5,
                                            #    beta_regularizer=tf.keras.regularizers.l2(
                                            #        l=5e-4),
+                                           dtype=norm_dtype,
                                            name='fc1')(x)
     return x
 
@@ -137,6 +144,7 @@ def ResNet50():
                                            #        l=5e-4),
                                            gamma_regularizer=tf.keras.regularizers.l2(
                                                l=5e-4),
+                                           dtype=norm_dtype,
                                            name='bn0')(x)
     # x = tf.keras.layers.Activation('prelu')(x)
     x = tf.keras.layers.PReLU(
@@ -177,10 +185,14 @@ def ResNet50():
 
 
 class train_model(tf.keras.Model):
-    def __init__(self):
+    def __init__(self, sample_rate=1.0, classifier_devices=None):
         super(train_model, self).__init__()
         self.resnet = ResNet50()
-        self.arcface = Arcfacelayer()
+        if classifier_devices:
+            # returns (per example loss, predicted class) instead of logits
+            self.arcface = ShardedArcfacelayer(devices=classifier_devices)
+        else:
+            self.arcface = Arcfacelayer(sample_rate=sample_rate)
 
     def call(self, x, y):
         x = self.resnet(x)
@@ -1,8 +1,9 @@
 import tensorflow as tf
 import os
-from arcface import Arcfacelayer
+from arcface import Arcfacelayer, ShardedArcfacelayer
 
 bn_axis = -1
+norm_dtype = 'float32'  # normalization stays float32 under a mixed precision policy
 initializer = 'glorot_normal'
 
 
@@ -110,56 +111,42 @@ class GroupNormalization(tf.keras.layers.Layer):
             self.beta = None
         self.built = True
 
-    def call(self, inputs, **kwargs):
-        input_shape = tf.keras.backend.int_shape(inputs)
-        tensor_input_shape = tf.keras.backend.shape(inputs)
+    def group_shapes(self, inputs):
+        """
+        Shapes of the grouped input and of the per group parameters. The input is reshaped to
+        (batch, groups, ...) with the normalized axis divided by the number of groups; static
+        dimensions are used when the input shape is known apart from the batch size.
+        """
+        input_shape = inputs.shape.as_list()
+        if None in input_shape[1:]:
+            input_shape = [tf.shape(inputs)[i] if d is None else d
+                           for i, d in enumerate(input_shape)]
+        group_shape = [-1] + input_shape[1:]
+        group_shape[self.axis] = input_shape[self.axis] // self.groups
+        group_shape.insert(1, self.groups)
 
-        # Prepare broadcasting shape.
-        reduction_axes = list(range(len(input_shape)))
-        del reduction_axes[self.axis]
         broadcast_shape = [1] * len(input_shape)
         broadcast_shape[self.axis] = input_shape[self.axis] // self.groups
         broadcast_shape.insert(1, self.groups)
+        return [-1] + input_shape[1:], group_shape, broadcast_shape
 
-        reshape_group_shape = tf.keras.backend.shape(inputs)
-        group_axes = [reshape_group_shape[i] for i in range(len(input_shape))]
-        group_axes[self.axis] = input_shape[self.axis] // self.groups
-        group_axes.insert(1, self.groups)
-
-        # reshape inputs to new group shape
-        group_shape = [group_axes[0], self.groups] + group_axes[2:]
-        group_shape = tf.keras.backend.stack(group_shape)
-        inputs = tf.keras.backend.reshape(inputs, group_shape)
-
-        group_reduction_axes = list(range(len(group_axes)))
-        group_reduction_axes = group_reduction_axes[2:]
-
-        mean = tf.keras.backend.mean(
-            inputs, axis=group_reduction_axes, keepdims=True)
-        variance = tf.keras.backend.var(
-            inputs, axis=group_reduction_axes, keepdims=True)
-
-        inputs = (inputs - mean) / \
-            (tf.keras.backend.sqrt(variance + self.epsilon))
-
-        # prepare broadcast shape
-        inputs = tf.keras.backend.reshape(inputs, group_shape)
-        outputs = inputs
-
-        # In this case we must explicitly broadcast all parameters.
+    def call(self, inputs, **kwargs):
+        # the groups are formed by reshaping the input, exactly as the original
+        # implementation did, so trained checkpoints give the same outputs
+        output_shape, group_shape, broadcast_shape = self.group_shapes(inputs)
+        grouped = tf.reshape(inputs, group_shape)
+        mean, variance = tf.nn.moments(grouped, axes=list(range(2, len(group_shape))),
+                                       keepdims=True)
+
+        # fold normalization, gamma and beta into one scale and shift
+        scale = tf.math.rsqrt(variance + self.epsilon)
         if self.scale:
-            broadcast_gamma = tf.keras.backend.reshape(
-                self.gamma, broadcast_shape)
-            outputs = outputs * broadcast_gamma
-
+            scale = scale * tf.reshape(self.gamma, broadcast_shape)
+        shift = -mean * scale
         if self.center:
-            broadcast_beta = tf.keras.backend.reshape(
-                self.beta, broadcast_shape)
-            outputs = outputs + broadcast_beta
+            shift = shift + tf.reshape(self.beta, broadcast_shape)
 
-        outputs = tf.keras.backend.reshape(outputs, tensor_input_shape)
-
-        return outputs
+        return tf.reshape(grouped * scale + shift, output_shape)
 
     def get_config(self):
         config = {
@@ -194,6 +181,7 @@ def residual_unit_v3(input, num_filter, stride, dim_match, name):
                            #        l=5e-4),
                            gamma_regularizer=tf.keras.regularizers.l2(
                                l=5e-4),
+                           dtype=norm_dtype,
                            name=name + '_bn1')(input)
     x = tf.keras.layers.ZeroPadding2D(
         padding=(1, 1), name=name + '_conv1_pad')(x)
@@ -212,6 +200,7 @@ def residual_unit_v3(input, num_filter, stride, dim_match, name):
                            #        l=5e-4),
                            gamma_regularizer=tf.keras.regularizers.l2(
                                l=5e-4),
+                           dtype=norm_dtype,
                            name=name + '_bn2')(x)
     x = tf.keras.layers.PReLU(name=name + '_relu1',
                               alpha_regularizer=tf.keras.regularizers.l2(
@@ -233,6 +222,7 @@ def residual_unit_v3(input, num_filter, stride, dim_match, name):
                            #        l=5e-4),
                            gamma_regularizer=tf.keras.regularizers.l2(
                                l=5e-4),
+                           dtype=norm_dtype,
                            name=name + '_bn3')(x)
     if (dim_match):
         shortcut = input
@@ -252,6 +242,7 @@ def residual_unit_v3(input, num_filter, stride, dim_match, name):
                                       #       l=5e-4),
                                       gamma_regularizer=tf.keras.regularizers.l2(
                                           l=5e-4),
+                                      dtype=norm_dtype,
                                       name=name + '_sc')(shortcut)
     return x + shortcut
 
@@ -264,6 +255,7 @@ def get_fc1(input):
                            #        l=5e-4),
                            gamma_regularizer=tf.keras.regularizers.l2(
                                l=5e-4),
+                           dtype=norm_dtype,
                            name='bn1')(input)
     x = tf.keras.layers.Dropout(0.4)(x)
     resnet_shape = input.shape
@@ -280,6 +272,7 @@ def get_fc1(input):
                            epsilon=2e-5,
                            #    beta_regularizer=tf.keras.regularizers.l2(
                            #        l=5e-4),
+                           dtype=norm_dtype,
                            name='fc1')(x)
     return x
 
@@ -310,6 +303,7 @@ def ResNet50():
                            #        l=5e-4),
                            gamma_regularizer=tf.keras.regularizers.l2(
                                l=5e-4),
+                           dtype=norm_dtype,
                            name='bn0')(x)
     # x = tf.keras.layers.Activation('prelu')(x)
     x = tf.keras.layers.PReLU(
@@ -350,10 +344,14 @@ def ResNet50():
 
 
 class train_model(tf.keras.Model):
-    def __init__(self):
+    def __init__(self, sample_rate=1.0, classifier_devices=None):
         super(train_model, self).__init__()
         self.resnet = ResNet50()
-        self.arcface = Arcfacelayer()
+        if classifier_devices:
+            # returns (per example loss, predicted class) instead of logits
+            self.arcface = ShardedArcfacelayer(devices=classifier_devices)
+        else:
+            self.arcface = Arcfacelayer(sample_rate=sample_rate)
 
     def call(self, x, y):
         x = self.resnet(x)
@@ -7,6 +7,8 @@ import numpy as np
 batch_size = 16
 batch_multiplier = 2
 reg_coef = 1.0
+sample_rate = 1.0  # partial FC: fraction of the class centers used per step, e.g. 0.1
+mixed_precision = None  # 'mixed_float16' (GPU) or 'mixed_bfloat16' (TPU, recent CPUs)
 
 def parse_function(example_proto):
     features = {'image_raw': tf.io.FixedLenFeature([], tf.string),
@@ -15,13 +17,17 @@ def parse_function(example_proto):
     img = tf.image.decode_jpeg(features['image_raw'])
     #img = tf.reshape(img, shape=(350, 350, 3))
     img = tf.image.resize(img, (112, 112))
-    r, g, b = tf.split(img, num_or_size_splits=3, axis=-1)
-    img = tf.concat([b, g, r], axis=-1)
+    label = tf.cast(features['label'], tf.int32)
+    return img, label
+
+
+def preprocess(img, label):
+    # batched RGB -> normalized BGR
+    img = tf.reverse(img, axis=[-1])
     img = tf.cast(img, dtype=tf.float32)
     img = tf.subtract(img, 127.5)
     img = tf.multiply(img, 0.0078125)
     img = tf.image.random_flip_left_right(img)
-    label = tf.cast(features['label'], tf.int32)
     return img, label
 
 
@@ -29,39 +35,83 @@ dataset = tf.data.TFRecordDataset('femaleface_train.tfrecord')
 dataset = dataset.map(parse_function)
 dataset = dataset.shuffle(buffer_size=20000)
 dataset = dataset.batch(batch_size * batch_multiplier)
+# pre-decoded shards (convert_dataset --decoded) skip the JPEG decoding:
+# from data_pipeline import read_metadata, decoded_dataset
+# dataset = decoded_dataset(read_metadata('femaleface_train_decoded.npy')['shards'],
+#                           batch_size * batch_multiplier)
+dataset = dataset.map(preprocess)
+
+if mixed_precision:
+    # float16/bfloat16 convolutions, normalization and ArcFace logits stay float32
+    tf.keras.mixed_precision.set_global_policy(mixed_precision)
 
 print("Preparing model...")
 
-model = train_model()
+model = train_model(sample_rate=sample_rate)
 
 # learning_rate = 0.0005
 learning_rate = 0.0006
 # optimizer = tf.keras.optimizers.SGD(lr=learning_rate, momentum=0.9, nesterov=False)
 optimizer = tf.keras.optimizers.Adam(lr=learning_rate)
 # optimizer = tf.keras.optimizers.Adagrad(lr=learning_rate, decay=0.0)
+loss_scale_optimizer = None
+if mixed_precision == 'mixed_float16':
+    # dynamic loss scaling keeps small float16 gradients from underflowing
+    loss_scale_optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+
+
+# build the model, then one gradient accumulator per trainable variable
+model(tf.zeros((1, 112, 112, 3)), tf.zeros((1,), dtype=tf.int32))
+accumulators = [tf.Variable(tf.zeros_like(v), trainable=False) for v in model.trainable_variables]
 
 
 @tf.function
-def train_step(images, labels, regCoef):
-    # print(images, labels)
+def accumulate_step(images, labels, regCoef):
+    # forward and backward pass of one micro batch, its gradients are added to the accumulators
     with tf.GradientTape() as tape:
-        logits = model(tf.slice(images, [0, 0, 0, 0], [
-                       batch_size, 112, 112, 3]), tf.slice(labels, [0], [batch_size]))
-        for i in range(batch_multiplier - 1):
-            logits = tf.concat([logits, model(tf.slice(images, [batch_size * (i + 1), 0, 0, 0], [
-                               batch_size, 112, 112, 3]), tf.slice(labels, [batch_size * (i + 1)], [batch_size]))], 0)
-        pred = tf.nn.softmax(logits)
+        logits = model(images, labels)
+        if sample_rate < 1.0:
+            # logits over the classes sampled for this micro batch, labels remapped to them
+            logits, labels = logits
         inf_loss = tf.reduce_mean(
             tf.nn.sparse_softmax_cross_entropy_with_logits(logits=logits, labels=labels))
         reg_loss = tf.add_n(model.losses)
         loss = inf_loss + reg_loss * regCoef
-    gradients = tape.gradient(loss, model.trainable_variables)
-    optimizer.apply_gradients(zip(gradients, model.trainable_variables))
-    train_loss = tf.reduce_mean(loss)
+        # the accumulated gradients are those of the mean loss over all micro batches
+        step_loss = loss / batch_multiplier
+        if loss_scale_optimizer:
+            step_loss = loss_scale_optimizer.get_scaled_loss(step_loss)
+    gradients = tape.gradient(step_loss, model.trainable_variables)
+    if loss_scale_optimizer:
+        gradients = loss_scale_optimizer.get_unscaled_gradients(gradients)
+    for accumulator, gradient in zip(accumulators, gradients):
+        accumulator.assign_add(tf.convert_to_tensor(gradient))
     accuracy = tf.reduce_mean(
-        tf.cast(tf.equal(tf.argmax(pred, axis=1, output_type=tf.dtypes.int32), labels), dtype=tf.float32))
-    inference_loss = tf.reduce_mean(inf_loss)
-    regularization_loss = tf.reduce_mean(reg_loss)
+        tf.cast(tf.equal(tf.argmax(logits, axis=1, output_type=tf.dtypes.int32), labels), dtype=tf.float32))
+    return accuracy, loss, inf_loss, reg_loss
+
+
+@tf.function
+def apply_step():
+    (loss_scale_optimizer or optimizer).apply_gradients(
+        zip([accumulator.value() for accumulator in accumulators], model.trainable_variables))
+    for accumulator in accumulators:
+        accumulator.assign(tf.zeros_like(accumulator))
+
+
+def train_step(images, labels, regCoef):
+    """
+    One optimizer step on batch_size * batch_multiplier images. The batch is processed in
+    batch_multiplier micro batches of batch_size images, so only the activations of one micro
+    batch are alive at a time.
+    """
+    results = []
+    for i in range(batch_multiplier):
+        results.append(accumulate_step(images[batch_size * i:batch_size * (i + 1)],
+                                       labels[batch_size * i:batch_size * (i + 1)], regCoef))
+    apply_step()
+    accuracy, train_loss, inference_loss, regularization_loss = [
+        tf.reduce_mean(values) for values in zip(*results)]
     return accuracy, train_loss, inference_loss, regularization_loss
 
 
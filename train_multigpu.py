@@ -2,15 +2,26 @@
 from resnet_batchRenorm import train_model
 # from resnet import train_model
 import os
+import time
 import logging
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # FATAL
 logging.getLogger('tensorflow').setLevel(logging.FATAL)
 import tensorflow as tf
+from data_pipeline import read_metadata, interleaved_dataset, decoded_dataset
 
 batch_size = 128
 reg_coef = 1.0
 learning_rate = 0.0015
-buffer_size = 100000
+sample_rate = 1.0  # partial FC: fraction of the class centers used per step, e.g. 0.1
+mixed_precision = None  # 'mixed_float16' (GPU) or 'mixed_bfloat16' (TPU, recent CPUs)
+# model parallel classifier, e.g. ['/gpu:0', '/gpu:1']: the ArcFace kernel is split over
+# these devices and the backbone runs as one tower per device, without a distribution strategy
+classifier_devices = None
+buffer_size = 100000  # records ordered by identity
+shuffled_buffer_size = 10000  # enough for shards written by convert_dataset --shuffle
+tfrecord_path = 'dataset/converted_dataset/ms1m_train.tfrecord'
+# pre-decoded shards (convert_dataset --decoded), used instead of the tfrecords if present
+decoded_path = 'dataset/converted_dataset/ms1m_train_decoded.npy'
 
 gpus = tf.config.experimental.list_physical_devices('GPU')
 if gpus:
@@ -22,71 +33,120 @@ def parse_function(example_proto):
     features = {'image_raw': tf.io.FixedLenFeature([], tf.string),
                 'label': tf.io.FixedLenFeature([], tf.int64)}
     features = tf.io.parse_single_example(example_proto, features)
-    # img = tf.image.decode_jpeg(features['image_raw'])
-    # img = tf.reshape(img, shape=(112, 112, 3))
-    # r, g, b = tf.split(img, num_or_size_splits=3, axis=-1)
-    # img = tf.concat([b, g, r], axis=-1)
-    # img = tf.cast(img, dtype=tf.float32)
-    # img = tf.subtract(img, 127.5)
-    # img = tf.multiply(img, 0.0078125)
-    # img = tf.image.random_flip_left_right(img)
-    img = features['image_raw']
+    img = tf.image.decode_jpeg(features['image_raw'])
+    img = tf.reshape(img, shape=(112, 112, 3))
     label = tf.cast(features['label'], tf.int32)
     return img, label
 
 
-strategy = tf.distribute.experimental.CentralStorageStrategy()
-# strategy = tf.distribute.MirroredStrategy()
-num_replicas = strategy.num_replicas_in_sync
+def preprocess(img, label):
+    # batched uint8 RGB -> normalized BGR, in the input pipeline, outside the training step
+    img = tf.reverse(img, axis=[-1])
+    img = tf.cast(img, dtype=tf.float32)
+    img = tf.subtract(img, 127.5)
+    img = tf.multiply(img, 0.0078125)
+    img = tf.image.random_flip_left_right(img)
+    return img, label
+
+
+if mixed_precision:
+    # float16/bfloat16 convolutions, normalization and ArcFace logits stay float32
+    tf.keras.mixed_precision.set_global_policy(mixed_precision)
+
+if classifier_devices:
+    strategy = tf.distribute.get_strategy()
+    num_replicas = len(classifier_devices)
+else:
+    strategy = tf.distribute.experimental.CentralStorageStrategy()
+    # strategy = tf.distribute.MirroredStrategy()
+    num_replicas = strategy.num_replicas_in_sync
 
 
 with strategy.scope():
-    dataset = tf.data.TFRecordDataset(
-        'dataset/converted_dataset/ms1m_train.tfrecord')
-    dataset_size = sum(1 for _ in dataset)
-    dataset = dataset.map(parse_function)
-    dataset = dataset.shuffle(buffer_size=buffer_size).repeat().batch(
-        batch_size * num_replicas)
+    metadata = read_metadata(decoded_path)
+    if metadata is not None:
+        # no JPEG decoding: batches are sliced from the memory mapped uint8 shards
+        dataset = decoded_dataset(metadata['shards'], batch_size * num_replicas)
+        dataset_size = metadata['num_records']
+    else:
+        metadata = read_metadata(tfrecord_path)
+        if metadata is not None:
+            dataset = interleaved_dataset(metadata['shards'])
+            dataset_size = metadata['num_records']
+            if metadata['shuffled']:
+                buffer_size = shuffled_buffer_size
+        else:
+            print("No metadata for %s, counting records (run data_pipeline.py "
+                  "on it once to avoid this)..." % tfrecord_path)
+            dataset = tf.data.TFRecordDataset(tfrecord_path)
+            dataset_size = sum(1 for _ in dataset)
+        # shuffle the serialized records, decode in parallel
+        dataset = dataset.shuffle(buffer_size=buffer_size).repeat()
+        dataset = dataset.map(
+            parse_function, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        dataset = dataset.batch(batch_size * num_replicas)
+    dataset = dataset.map(
+        preprocess, num_parallel_calls=tf.data.experimental.AUTOTUNE).prefetch(
+        tf.data.experimental.AUTOTUNE)
     dist_dataset = strategy.experimental_distribute_dataset(dataset)
 
     print("Preparing model...")
 
-    model = train_model()
+    model = train_model(sample_rate=sample_rate, classifier_devices=classifier_devices)
     # model.load_weights('output/ckpt/ckpt_sgd_5/weights_step-1120000')
 
     optimizer = tf.keras.optimizers.SGD(
         lr=learning_rate, momentum=0.9, nesterov=False)
     # optimizer = tf.keras.optimizers.Adam(lr=learning_rate)
     # optimizer = tf.keras.optimizers.Adagrad(lr=learning_rate, decay=0.0)
+    loss_scale_optimizer = None
+    if mixed_precision == 'mixed_float16':
+        # dynamic loss scaling keeps small float16 gradients from underflowing
+        loss_scale_optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
 
 
 @tf.function
 def train_step(_images, _labels, _regCoef):
     def step_fn(images, labels, regCoef):
         with tf.GradientTape() as tape:
-            img = tf.image.decode_jpeg(images[0])
-            for i in range(batch_size - 1):
-                img = tf.concat(
-                    [img, tf.image.decode_jpeg(images[i + 1])], axis=0)
-            img = tf.reshape(img, shape=(-1, 112, 112, 3))
-            r, g, b = tf.split(img, num_or_size_splits=3, axis=-1)
-            img = tf.concat([b, g, r], axis=-1)
-            img = tf.cast(img, dtype=tf.float32)
-            img = tf.subtract(img, 127.5)
-            img = tf.multiply(img, 0.0078125)
-            img = tf.image.random_flip_left_right(img)
-            logits = model(img, labels)
-            pred = tf.nn.softmax(logits)
-            inf_loss = tf.reduce_sum(
-                tf.nn.sparse_softmax_cross_entropy_with_logits(logits=logits, labels=labels)) * (1.0 / batch_size)
+            if classifier_devices:
+                # one backbone tower per device, the classifier is sharded over the same devices
+                embeddings = []
+                for device, x in zip(classifier_devices, tf.split(images, num_replicas)):
+                    with tf.device(device):
+                        embeddings.append(model.resnet(x))
+                per_example_loss, pred = model.arcface(tf.concat(embeddings, 0), labels)
+            else:
+                if sample_rate < 1.0:
+                    # logits over the sampled classes, labels remapped to them
+                    logits, labels = model(images, labels)
+                else:
+                    logits = model(images, labels)
+                per_example_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(
+                    logits=logits, labels=labels)
+                pred = tf.argmax(logits, axis=1, output_type=tf.dtypes.int32)
             reg_loss = tf.add_n(model.losses)
-            # loss = (inf_loss + reg_loss * regCoef) * (1.0 / num_replicas)
-            loss = (inf_loss / regCoef + reg_loss) * (1.0 / num_replicas)
-        gradients = tape.gradient(loss, model.trainable_variables)
-        optimizer.apply_gradients(
-            zip(gradients, model.trainable_variables))
+            if classifier_devices:
+                # a single replica sees the global batch: no division by the replicas
+                inf_loss = tf.reduce_mean(per_example_loss)
+                loss = inf_loss / regCoef + reg_loss
+            else:
+                inf_loss = tf.reduce_sum(per_example_loss) * (1.0 / batch_size)
+                # loss = (inf_loss + reg_loss * regCoef) * (1.0 / num_replicas)
+                loss = (inf_loss / regCoef + reg_loss) * (1.0 / num_replicas)
+            if loss_scale_optimizer:
+                scaled_loss = loss_scale_optimizer.get_scaled_loss(loss)
+        if loss_scale_optimizer:
+            gradients = loss_scale_optimizer.get_unscaled_gradients(
+                tape.gradient(scaled_loss, model.trainable_variables))
+            loss_scale_optimizer.apply_gradients(
+                zip(gradients, model.trainable_variables))
+        else:
+            gradients = tape.gradient(loss, model.trainable_variables)
+            optimizer.apply_gradients(
+                zip(gradients, model.trainable_variables))
         accuracy = tf.reduce_mean(
-            tf.cast(tf.equal(tf.argmax(pred, axis=1, output_type=tf.dtypes.int32), labels), dtype=tf.float32))
+            tf.cast(tf.equal(pred, labels), dtype=tf.float32))
         return loss, inf_loss, reg_loss, accuracy
     loss, inf_loss, reg_loss, accuracy = strategy.experimental_run_v2(
         step_fn, args=(_images, _labels, _regCoef,))
@@ -120,18 +180,22 @@ lr_steps = [int(100000 * 512 / (batch_size * num_replicas)),
 
 step = 0
 epoch = 0
+time0 = time.time()
 for img, label in dist_dataset:
     step += 1
     epoch = (batch_size * num_replicas * step) // dataset_size
     accuracy, train_loss, inference_loss, regularization_loss = train_step(
         img, label, reg_coef)
     if step % 10 == 0:
-        template = 'Epoch {}, Step {}, Loss: {}, Reg loss: {}, Accuracy: {}, Reg coef: {}'
+        steps_per_sec = 10 / (time.time() - time0)
+        time0 = time.time()
+        template = 'Epoch {}, Step {}, Loss: {}, Reg loss: {}, Accuracy: {}, Reg coef: {}, Steps/sec: {}'
         print(template.format(epoch + 1, step,
                               '%.5f' % (inference_loss),
                               '%.5f' % (regularization_loss),
                               '%.5f' % (accuracy),
-                              '%.5f' % (reg_coef)))
+                              '%.5f' % (reg_coef),
+                              '%.2f' % (steps_per_sec)))
         with summary_writer.as_default():
             tf.summary.scalar(
                 'train loss', train_loss, step=step)
@@ -143,6 +207,8 @@ for img, label in dist_dataset:
                 'train accuracy', accuracy, step=step)
             tf.summary.scalar(
                 'learning rate', optimizer.lr, step=step)
+            tf.summary.scalar(
+                'steps per second', steps_per_sec, step=step)
             # for i in range(len(gradients)):
             #     gradient_name = model.trainable_variables[i].name
             #     tf.summary.histogram(